@@ -0,0 +1,94 @@
+import logging
+import threading
+from hashlib import sha1
+from time import time
+
+from django.core.cache import get_cache
+from django.core.cache.backends.locmem import LocMemCache
+
+from .utils import get_setting
+
+logger = logging.getLogger(__name__)
+
+backends = {}
+stats = dict.fromkeys(('hits', 'misses'), 0)
+stats_lock = threading.Lock()
+
+
+def get_backend():
+    '''
+    The cache named by LIFESTREAMS_CACHE, created once per alias.
+    '''
+    alias = get_setting('LIFESTREAMS_CACHE')
+    if alias not in backends:
+        backends[alias] = get_cache(alias)
+        if isinstance(backends[alias], LocMemCache):
+            logger.warn("Cache '%s' is local to each process, versions bumped by update_lifestreams "
+                        "won't reach the web processes. Use a shared cache such as memcached.", alias)
+    return backends[alias]
+
+
+def get_version_key(name):
+    return 'lifestreams:version:%s' % sha1(name.encode('utf-8')).hexdigest()
+
+
+def get_version(name):
+    '''
+    Version of the items of the lifestream called name, cached output built
+    from them is stored under it.
+    '''
+    backend = get_backend()
+    key = get_version_key(name)
+    version = backend.get(key)
+    if version is None:
+        # Starting from the time keeps a lost version from coming back.
+        backend.add(key, int(time() * 1000000), get_setting('LIFESTREAMS_CACHE_TIMEOUT'))
+        version = backend.get(key)
+    return version
+
+
+def bump_version(name):
+    backend = get_backend()
+    key = get_version_key(name)
+    try:
+        return backend.incr(key)
+    except ValueError:
+        backend.add(key, int(time() * 1000000), get_setting('LIFESTREAMS_CACHE_TIMEOUT'))
+
+
+def get_cache_key(prefix, name, *args):
+    parts = ['lifestreams', prefix, sha1(name.encode('utf-8')).hexdigest(), get_version(name)] + list(args)
+    return ':'.join(unicode(part) for part in parts)
+
+
+def get_or_build(prefix, name, build, *args):
+    '''
+    The value cached for the current version of the lifestream called name,
+    build is called to create it on a miss.
+    '''
+    backend = get_backend()
+    key = get_cache_key(prefix, name, *args)
+    value = backend.get(key)
+    if value is None:
+        count('misses')
+        value = build()
+        backend.set(key, value, get_setting('LIFESTREAMS_CACHE_TIMEOUT'))
+    else:
+        count('hits')
+    return value
+
+
+def count(name):
+    with stats_lock:
+        stats[name] += 1
+
+
+def get_stats():
+    with stats_lock:
+        return dict(stats)
+
+
+def reset_stats():
+    with stats_lock:
+        for name in stats:
+            stats[name] = 0
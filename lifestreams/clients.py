@@ -0,0 +1,4 @@
+from .utils import LRUCache, get_setting
+
+# API clients by credentials, shared by every feed the process updates.
+client_cache = LRUCache(get_setting('LIFESTREAMS_CLIENT_CACHE_SIZE'))
@@ -6,3 +6,17 @@ class FeedNotConfiguredException(Exception):
 
 class FeedErrorException(Exception):
     pass
+
+
+class InvalidCursorException(Exception):
+    pass
+
+
+class FeedDeferredException(Exception):
+    '''
+    The feed can't be fetched now, retry_after is the number of seconds to wait.
+    '''
+
+    def __init__(self, retry_after=0):
+        super(FeedDeferredException, self).__init__(retry_after)
+        self.retry_after = retry_after
@@ -0,0 +1,71 @@
+from time import time
+
+from django.contrib.syndication.views import Feed
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse, HttpResponseNotModified
+from django.shortcuts import get_object_or_404
+from django.utils.feedgenerator import Atom1Feed
+from django.utils.http import http_date, parse_http_date_safe
+
+from .cache import get_or_build
+from .models import Lifestream
+
+
+class LifestreamFeed(Feed):
+    '''
+    RSS feed of the newest items of a lifestream. The output is cached until
+    the plugins save new items, cached requests don't query the database.
+    '''
+    limit = 30
+
+    def __call__(self, request, name):
+        def build():
+            response = super(LifestreamFeed, self).__call__(request, name)
+            # Backfilled items can be older than the newest one, the feed
+            # was modified when it was built for the current version.
+            return response.content, response['Content-Type'], http_date(time())
+        content, content_type, last_modified = get_or_build('syndication', name, build, self.__class__.__name__)
+        if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        if if_modified_since is not None and if_modified_since >= parse_http_date_safe(last_modified):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(content, content_type=content_type)
+        response['Last-Modified'] = last_modified
+        return response
+
+    def get_object(self, request, name):
+        return get_object_or_404(Lifestream, name=name)
+
+    def title(self, lifestream):
+        return lifestream.name
+
+    def link(self, lifestream):
+        return reverse('lifestream_rss', args=[lifestream.name])
+
+    def description(self, lifestream):
+        return lifestream.name
+
+    def items(self, lifestream):
+        return lifestream.get_items(limit=self.limit)
+
+    def item_title(self, item):
+        return item.author
+
+    def item_description(self, item):
+        return item.content
+
+    def item_link(self, item):
+        return item.link
+
+    def item_author_name(self, item):
+        return item.author
+
+    def item_pubdate(self, item):
+        return item.published
+
+
+class AtomLifestreamFeed(LifestreamFeed):
+    feed_type = Atom1Feed
+
+    def subtitle(self, lifestream):
+        return self.description(lifestream)
@@ -0,0 +1,33 @@
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from lifestreams.models import Lifestream, Item, TimelineEntry
+from lifestreams.utils import chunks
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    args = '<lifestream_name>'
+    help = 'Fills the timeline table from the items already stored.'
+
+    def handle(self, *args, **options):
+        lifestreams = Lifestream.objects.all()
+        if args:
+            lifestreams = lifestreams.filter(name=' '.join(args))
+        for lifestream in lifestreams:
+            count = self.rebuild(lifestream)
+            logger.info('%d items in the timeline of %s.', count, lifestream)
+
+    @transaction.commit_on_success
+    def rebuild(self, lifestream):
+        TimelineEntry.objects.filter(lifestream=lifestream).delete()
+        items = Item.objects.filter(feed__lifestream=lifestream).order_by().values_list('pk', 'published')
+        count = 0
+        for batch in chunks(items.iterator(), 1000):
+            TimelineEntry.objects.bulk_create([TimelineEntry(lifestream=lifestream, item_id=pk, published=published)
+                                               for pk, published in batch])
+            count += len(batch)
+        return count
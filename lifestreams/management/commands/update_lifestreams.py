@@ -1,18 +1,136 @@
 import logging
+import os
+import signal
+import socket
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+from time import sleep, time
 
 from django.core.management.base import BaseCommand
+from django.db import connections, reset_queries
+from django.db.models import Q
+from django.utils.timezone import now
 
-from lifestreams.models import Feed
-from lifestreams.exceptions import FeedNotConfiguredException, FeedErrorException
+from lifestreams.models import Feed, claim_feeds, extend_lease, release_feeds
+from lifestreams.registry import registry
+from lifestreams.ratelimit import rate_limiter
+from lifestreams.signals import update_started, update_finished
+from lifestreams.utils import get_setting
+from lifestreams.exceptions import FeedNotConfiguredException, FeedErrorException, FeedDeferredException
 
 logger = logging.getLogger(__name__)
 
 
 class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=1,
+                    help='Number of threads fetching feeds concurrently.'),
+        make_option('--due', action='store_true', dest='due', default=False,
+                    help='Only fetch feeds whose next fetch time has come.'),
+        make_option('--async', action='store_true', dest='async_fetch', default=False,
+                    help='Download the documents of every feed concurrently before updating them.'),
+        make_option('--processes', type='int', dest='processes', default=0,
+                    help='With --async, number of processes parsing the downloaded documents.'),
+        make_option('--daemon', action='store_true', dest='daemon', default=False,
+                    help='Keep running, updating the due feeds every --interval seconds.'),
+        make_option('--interval', type='int', dest='interval', default=60,
+                    help='With --daemon, seconds between the start of two updates.'),
+        make_option('--heartbeat', dest='heartbeat', default=None,
+                    help='With --daemon, file where the time of the last update is written.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=100,
+                    help='Number of feeds leased at once.'),
+    )
+
     def handle(self, *args, **options):
+        registry.populate()
+        self.stopping = False
+        # Feeds are leased to this process so other nodes skip them.
+        self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+        if options.get('daemon'):
+            options['due'] = True
+            self.__run_daemon(args, options)
+        else:
+            self.__run(args, options)
+
+    def __run_daemon(self, args, options):
+        interval = options.get('interval')
+        heartbeat = options.get('heartbeat')
+        handlers = {}
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            handlers[signum] = signal.signal(signum, self.__stop)
+            # Restart the system calls of the feeds being fetched instead of
+            # failing them with EINTR.
+            signal.siginterrupt(signum, False)
+        logger.info('Updating lifestreams every %d seconds.', interval)
+        try:
+            while not self.stopping:
+                started = time()
+                try:
+                    self.__run(args, options)
+                except Exception:
+                    logger.exception('Lifestreams update failed.')
+                # Connections are opened again by the next update if needed.
+                for connection in connections.all():
+                    connection.close()
+                reset_queries()
+                if heartbeat:
+                    self.__beat(heartbeat)
+                self.__sleep(interval - (time() - started))
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+        logger.info('Stopped updating lifestreams.')
+
+    def __stop(self, signum, frame):
+        logger.info('Stopping after the feeds being updated.')
+        self.stopping = True
+
+    def __sleep(self, seconds):
+        while seconds > 0 and not self.stopping:
+            sleep(min(seconds, 1))
+            seconds -= 1
+
+    def __beat(self, path):
+        with open(path, 'w') as heartbeat:
+            heartbeat.write('%s\n' % now().isoformat())
+
+    def __run(self, args, options):
+        rate_limiter.load()
+        update_started.send(sender=self.__class__)
+        self.stats = dict.fromkeys(('updated', 'not_modified', 'not_configured', 'error', 'deferred', 'lost'), 0)
         queryset = self.__get_queryset(args)
-        for feed in queryset:
-            self.__update(feed)
+        if options.get('due'):
+            queryset = queryset.filter(Q(next_fetch_at__isnull=True) | Q(next_fetch_at__lte=now()))
+        workers = options.get('workers') or 1
+        batch_size = options.get('batch_size') or 100
+        self.lease_seconds = get_setting('LIFESTREAMS_LEASE_SECONDS')
+        last_pk = 0
+        try:
+            while not self.stopping:
+                feeds = claim_feeds(queryset.filter(pk__gt=last_pk), self.owner, batch_size, self.lease_seconds)
+                if not feeds:
+                    break
+                last_pk = feeds[-1].pk
+                try:
+                    if options.get('async_fetch'):
+                        self.__update_prefetched(feeds, workers, options.get('processes') or 0)
+                    elif workers > 1:
+                        self.__update_concurrently(feeds, workers)
+                    else:
+                        for feed in feeds:
+                            if self.stopping:
+                                break
+                            self.__update(feed, feed.update)
+                finally:
+                    release_feeds(feeds, self.owner)
+        finally:
+            rate_limiter.save()
+        logger.info('%(updated)d feeds updated, %(not_modified)d not modified, %(not_configured)d '
+                    'not configured, %(error)d with errors, %(deferred)d deferred, %(lost)d lost.', self.stats)
+        for key, remaining in sorted(rate_limiter.remaining().items()):
+            logger.info('%d calls left for %s.', remaining, key)
+        update_finished.send(sender=self.__class__, stats=self.stats)
 
     def __get_queryset(self, args):
         queryset = Feed.objects.all()
@@ -21,11 +139,91 @@ class Command(BaseCommand):
             queryset = queryset.filter(lifestream__name=lifestream)
         return queryset
 
-    def __update(self, feed):
+    def __update_concurrently(self, feeds, workers):
+        # Workers only talk to the network, items are saved from this thread.
+        feeds = [feed for feed in feeds if feed.fetchable]
+        pool = ThreadPool(workers)
+        try:
+            for feed, plugin, items, error in pool.imap_unordered(self.__fetch, feeds):
+                if plugin is None and error is None:
+                    continue
+                self.__update(feed, partial(self.__save, plugin, items, error))
+        except:
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+
+    def __update_prefetched(self, feeds, workers, processes):
+        plugins = {}
+        for feed in feeds:
+            if not feed.fetchable:
+                continue
+            plugin = feed.get_plugin()
+            plugins.setdefault(plugin.__class__, []).append(plugin)
+        for PluginClass, group in plugins.items():
+            PluginClass.prefetch(group, workers=workers, processes=processes)
+        for group in plugins.values():
+            for plugin in group:
+                if self.stopping:
+                    return
+                self.__update(plugin.feed, plugin.update)
+
+    def __fetch(self, feed):
+        if self.stopping:
+            return feed, None, None, None
+        plugin = None
+        entries = []
+        try:
+            plugin = feed.get_plugin()
+            # Entries fetched before an error are still saved, they carry
+            # the checkpoint an interrupted update resumes from.
+            for entry in plugin.fetch():
+                entries.append(entry)
+            return feed, plugin, entries, None
+        except (FeedNotConfiguredException, FeedErrorException, FeedDeferredException), e:
+            return feed, plugin, entries, e
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+    def __save(self, plugin, items, error):
+        if error is not None:
+            if plugin is None or not items:
+                raise error
+            items = self.__replay(items, error)
+        return plugin.save(items)
+
+    def __replay(self, items, error):
+        for item in items:
+            yield item
+        raise error
+
+    def __update(self, feed, update):
+        # The lease is renewed before each feed, a batch can outlive it.
+        if not extend_lease(feed, self.owner, self.lease_seconds):
+            self.stats['lost'] += 1
+            logger.warn('Feed %s<%d> not updated, its lease was taken by another worker.', feed, feed.id)
+            return
         try:
-            feed.update()
-            logger.info('Feed %s<%d> updated.', feed, feed.id)
+            plugin = update()
+            if plugin is not None and plugin.not_modified:
+                self.stats['not_modified'] += 1
+                logger.info('Feed %s<%d> not modified.', feed, feed.id)
+            else:
+                self.stats['updated'] += 1
+                logger.info('Feed %s<%d> updated.', feed, feed.id)
         except FeedNotConfiguredException:
+            self.stats['not_configured'] += 1
+            # Failing feeds back off like the ones with nothing new.
+            feed.schedule()
             logger.warn('Feed %s<%d> not updated due to FeedNotConfiguredException.', feed, feed.id)
         except FeedErrorException:
+            self.stats['error'] += 1
+            feed.schedule()
             logger.warn('Feed %s<%d> not updated due to a feed error.', feed, feed.id)
+        except FeedDeferredException, e:
+            self.stats['deferred'] += 1
+            feed.defer(e.retry_after)
+            logger.info('Feed %s<%d> deferred %d seconds, no rate limit budget left.', feed, feed.id,
+                        e.retry_after)
@@ -1,7 +1,20 @@
+import heapq
+from datetime import timedelta
+
 from django.db import models
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.db.models.query import prefetch_related_objects
+from django.dispatch import receiver
+from django.template import Context
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 
-from .utils import get_setting, split_class_name, get_class
+from .utils import LRUCache, get_setting, encode_cursor, decode_cursor, to_microseconds
+from .registry import registry
+from .cache import bump_version, get_or_build
 
 
 class Lifestream(models.Model):
@@ -9,8 +22,46 @@ class Lifestream(models.Model):
     '''
     name = models.CharField(_('Name'), max_length=100, unique=True)
 
-    def get_items(self):
-        return Item.objects.filter(feed__lifestream=self)
+    def get_items(self, before=None, limit=None):
+        '''
+        All the items of the lifestream. With before (a cursor from
+        Item.get_cursor) or limit the items are paginated by (published, id),
+        from the timeline table when LIFESTREAMS_TIMELINE is on.
+        '''
+        items = Item.objects.filter(feed__lifestream=self)
+        if before is None and limit is None:
+            return items
+        if get_setting('LIFESTREAMS_TIMELINE'):
+            entries = self.timeline.order_by('-published', '-item')
+            entries = paginate(entries, before, limit, 'item')
+            pks = list(entries.values_list('item', flat=True))
+            return Item.objects.filter(pk__in=pks).order_by('-published', '-id')
+        return paginate(items.order_by('-published', '-id'), before, limit, 'pk')
+
+    def get_merged_items(self, limit, before=None, chunk_size=None):
+        '''
+        The same page as get_items(before, limit), merged from one query per
+        feed on its (feed, published, id) index instead of sorting the items of
+        every feed. A feed is read chunk_size items at a time, by default one
+        more than its share of the page, and only when its items run out.
+        '''
+        feeds = list(self.feeds.all())
+        if not feeds or limit <= 0:
+            return []
+        if chunk_size is None:
+            chunk_size = limit // len(feeds) + 1
+        published, pk = before is not None and decode_cursor(before) or (None, None)
+        heap = []
+        for feed in feeds:
+            push_item(heap, iter_feed_items(feed, published, pk, chunk_size))
+        merged = []
+        while heap:
+            key, item, items = heapq.heappop(heap)
+            merged.append(item)
+            if len(merged) == limit:
+                break
+            push_item(heap, items)
+        return merged
 
     class Meta:
         verbose_name = _('Lifestream')
@@ -21,6 +72,47 @@ class Lifestream(models.Model):
 
 
 
+def paginate(queryset, before, limit, pk_field):
+    if before is not None:
+        published, pk = decode_cursor(before)
+        queryset = older_than(queryset, published, pk, pk_field)
+    if limit is not None:
+        queryset = queryset[:limit]
+    return queryset
+
+
+def older_than(queryset, published, pk, pk_field='pk'):
+    return queryset.filter(Q(published__lt=published) | Q(**{'published': published, '%s__lt' % pk_field: pk}))
+
+
+def iter_feed_items(feed, published, pk, chunk_size):
+    '''
+    Items of feed older than (published, pk), newest first, queried
+    chunk_size at a time.
+    '''
+    queryset = Item.objects.filter(feed=feed).order_by('-published', '-id')
+    while True:
+        chunk = queryset
+        if published is not None:
+            chunk = older_than(chunk, published, pk)
+        chunk = list(chunk[:chunk_size])
+        for item in chunk:
+            item.feed = feed
+            yield item
+        if len(chunk) < chunk_size:
+            return
+        published, pk = chunk[-1].published, chunk[-1].pk
+
+
+def push_item(heap, items):
+    try:
+        item = next(items)
+    except StopIteration:
+        return
+    # heapq pops the smallest key first, the newest item has the smallest.
+    heapq.heappush(heap, ((-to_microseconds(item.published), -item.pk), item, items))
+
+
 class Feed(models.Model):
     '''
     '''
@@ -31,6 +123,12 @@ class Feed(models.Model):
     created = models.DateTimeField(_('Created'), auto_now_add=True)
     updated = models.DateTimeField(_('Updated'), auto_now=True)
     fetchable = models.BooleanField(_('Fetchable'), default=True)
+    last_id = models.CharField(_('Last ID'), max_length=255, blank=True)
+    last_published = models.DateTimeField(_('Last Published'), null=True, blank=True)
+    fetch_interval = models.PositiveIntegerField(_('Fetch Interval'), default=0)
+    next_fetch_at = models.DateTimeField(_('Next Fetch'), null=True, blank=True, db_index=True)
+    lease_owner = models.CharField(_('Lease Owner'), max_length=100, blank=True)
+    lease_expires = models.DateTimeField(_('Lease Expires'), null=True, blank=True, db_index=True)
 
     class Meta:
         verbose_name = _('Feed')
@@ -38,8 +136,7 @@ class Feed(models.Model):
         ordering = ('ordering', 'created')
 
     def get_plugin(self):
-        plugin_mod_name, plugin_class_name = split_class_name(self.feed_plugin)
-        PluginClass = get_class(plugin_mod_name, plugin_class_name)
+        PluginClass = registry.get(self.feed_plugin)
         return PluginClass(feed=self)
 
     def update(self):
@@ -47,10 +144,76 @@ class Feed(models.Model):
             plugin = self.get_plugin()
             return plugin.update()
 
+    def schedule(self, new_items=0):
+        '''
+        Sets when the feed should be fetched again: half the recent posting
+        interval after new items, twice the last interval otherwise.
+        '''
+        min_interval = get_setting('LIFESTREAMS_MIN_FETCH_INTERVAL')
+        max_interval = get_setting('LIFESTREAMS_MAX_FETCH_INTERVAL')
+        if new_items:
+            interval = self.get_posting_interval() / 2
+        else:
+            interval = max(self.fetch_interval, min_interval) * 2
+        self.fetch_interval = max(min_interval, min(max_interval, interval))
+        self.next_fetch_at = now() + timedelta(seconds=self.fetch_interval)
+        Feed.objects.filter(pk=self.pk).update(fetch_interval=self.fetch_interval,
+                                               next_fetch_at=self.next_fetch_at)
+
+    def defer(self, seconds):
+        '''
+        Postpones the next fetch without touching the fetch interval.
+        '''
+        self.next_fetch_at = now() + timedelta(seconds=seconds)
+        Feed.objects.filter(pk=self.pk).update(next_fetch_at=self.next_fetch_at)
+
+    def get_posting_interval(self, samples=10):
+        published = list(self.items.order_by('-published').values_list('published', flat=True)[:samples])
+        if len(published) < 2:
+            return 0
+        delta = published[0] - published[-1]
+        return (delta.days * 86400 + delta.seconds) / (len(published) - 1)
+
     def __unicode__(self):
         return "%s - %s" % (self.lifestream.name, self.title)
 
 
+def claim_feeds(queryset, owner, limit, seconds):
+    '''
+    Leases up to limit feeds of queryset that no one else holds to owner for
+    the given seconds, by primary key order. The lease is taken with a
+    conditional update, so two workers never get the same feed.
+    '''
+    current = now()
+    expires = current + timedelta(seconds=seconds)
+    free = Q(lease_expires__isnull=True) | Q(lease_expires__lte=current)
+    while True:
+        pks = list(queryset.filter(free).order_by('pk').values_list('pk', flat=True)[:limit])
+        if not pks:
+            return []
+        Feed.objects.filter(free, pk__in=pks).update(lease_owner=owner, lease_expires=expires)
+        feeds = list(Feed.objects.filter(pk__in=pks, lease_owner=owner, lease_expires=expires)
+                                 .select_related('lifestream').order_by('pk'))
+        if feeds:
+            return feeds
+        # Other workers took them all first.
+        queryset = queryset.filter(pk__gt=pks[-1])
+
+
+def extend_lease(feed, owner, seconds):
+    '''
+    Keeps the lease of owner on feed for the given seconds from now, False
+    when it expired and another worker took the feed.
+    '''
+    expires = now() + timedelta(seconds=seconds)
+    return Feed.objects.filter(pk=feed.pk, lease_owner=owner).update(lease_expires=expires) == 1
+
+
+def release_feeds(feeds, owner):
+    Feed.objects.filter(pk__in=[feed.pk for feed in feeds], lease_owner=owner).update(lease_owner='',
+                                                                                       lease_expires=None)
+
+
 class Item(models.Model):
     '''
     '''
@@ -67,14 +230,152 @@ class Item(models.Model):
         verbose_name = _('Item')
         verbose_name_plural = _('Items')
         ordering = ('-published', '-created', '-updated')
+        index_together = (('feed', 'link'), ('feed', 'published', 'id'))
 
 
     def __unicode__(self):
         return "%s %s" % (self.author, self.published)
 
+    def get_cursor(self):
+        return encode_cursor(self.published, self.pk)
+
     def render(self, suffix=''):
         from django.template.loader import render_to_string
         plugin = self.feed.get_plugin()
         default_template_name = plugin.get_template_name()
         template_name = '%s%s' % (suffix, default_template_name)
         return render_to_string(template_name, {'item': self})
+
+
+class TimelineEntry(models.Model):
+    '''
+    Copy of the order of the items of a lifestream, written as they are
+    saved, so a page of the lifestream is read from a single index.
+    '''
+    lifestream = models.ForeignKey('Lifestream', verbose_name=_('Lifestream'), related_name='timeline')
+    item = models.OneToOneField('Item', verbose_name=_('Item'), related_name='timeline_entry')
+    published = models.DateTimeField(_('Published'))
+
+    class Meta:
+        verbose_name = _('Timeline entry')
+        verbose_name_plural = _('Timeline entries')
+        index_together = (('lifestream', 'published', 'item'),)
+
+    def __unicode__(self):
+        return "%s %s" % (self.lifestream_id, self.item_id)
+
+    @classmethod
+    def create_for(cls, feed, items):
+        cls.objects.bulk_create([cls(lifestream_id=feed.lifestream_id, item_id=item.pk, published=item.published)
+                                 for item in items])
+
+
+@receiver(post_save, sender=Item)
+def add_to_timeline(sender, instance, created, raw=False, **kwargs):
+    # Items saved by the plugins are bulk created and added by BasePlugin.
+    if created and not raw and get_setting('LIFESTREAMS_TIMELINE'):
+        TimelineEntry.create_for(instance.feed, [instance])
+
+
+# Lifestream names by feed id, for the items saved and deleted one by one.
+lifestream_names = LRUCache(1000)
+
+
+@receiver(post_save, sender=Feed)
+@receiver(post_save, sender=Lifestream)
+@receiver(post_delete, sender=Feed)
+@receiver(post_delete, sender=Lifestream)
+def clear_lifestream_names(sender, **kwargs):
+    lifestream_names.clear()
+
+
+def get_lifestream_name(feed_id):
+    name = lifestream_names.get(feed_id)
+    if name is None:
+        names = list(Lifestream.objects.filter(feeds=feed_id).values_list('name', flat=True)[:1])
+        if not names:
+            return None
+        name = names[0]
+        lifestream_names.set(feed_id, name)
+    return name
+
+
+@receiver(post_save, sender=Item)
+def item_saved(sender, instance, raw=False, **kwargs):
+    # The plugins bump the version once per update.
+    if not raw:
+        name = get_lifestream_name(instance.feed_id)
+        if name is not None:
+            bump_version(name)
+
+
+@receiver(pre_delete, sender=Item)
+def item_deleting(sender, instance, **kwargs):
+    # Items are deleted before their feed, but post_delete is sent after it
+    # is gone too.
+    instance._lifestream_name = get_lifestream_name(instance.feed_id)
+
+
+@receiver(post_delete, sender=Item)
+def item_deleted(sender, instance, **kwargs):
+    name = getattr(instance, '_lifestream_name', None)
+    if name is not None:
+        bump_version(name)
+
+
+@receiver(pre_delete, sender=Lifestream)
+def lifestream_deleted(sender, instance, **kwargs):
+    bump_version(instance.name)
+
+
+class RateLimit(models.Model):
+    '''
+    Token bucket state of a rate limited API, kept between updates.
+    '''
+    key = models.CharField(_('Key'), max_length=255, unique=True)
+    capacity = models.PositiveIntegerField(_('Capacity'))
+    window = models.PositiveIntegerField(_('Window'))
+    tokens = models.FloatField(_('Tokens'))
+    refreshed = models.DateTimeField(_('Refreshed'))
+
+    class Meta:
+        verbose_name = _('Rate limit')
+        verbose_name_plural = _('Rate limits')
+
+    def __unicode__(self):
+        return self.key
+
+
+def render_items(items, suffix=''):
+    '''
+    Renders a list of items loading feeds and plugin related objects in bulk,
+    each plugin template is loaded only once.
+    '''
+    items = list(items)
+    prefetch_related_objects(items, ['feed'])
+    plugins = {}
+    for item in items:
+        if item.feed.feed_plugin not in plugins:
+            plugins[item.feed.feed_plugin] = item.feed.get_plugin()
+    related_names = [plugin.get_related_name() for plugin in plugins.values()
+                     if plugin.related_model is not None]
+    prefetch_related_objects(items, related_names)
+    templates = {}
+    for path, plugin in plugins.items():
+        templates[path] = get_template('%s%s' % (suffix, plugin.get_template_name()))
+    return mark_safe(''.join(templates[item.feed.feed_plugin].render(Context({'item': item}))
+                             for item in items))
+
+
+def render_timeline(name, limit=20, suffix=''):
+    '''
+    Renders the newest items of the lifestream called name like render_items,
+    cached until new items are saved.
+    '''
+    def build():
+        try:
+            lifestream = Lifestream.objects.get(name=name)
+        except Lifestream.DoesNotExist:
+            return u''
+        return unicode(render_items(lifestream.get_items(limit=limit), suffix))
+    return mark_safe(get_or_build('timeline', name, build, limit, suffix))
@@ -1,19 +1,101 @@
+from django.db import transaction
+
+from lifestreams.cache import bump_version
+from lifestreams.models import Feed, Item, TimelineEntry
+from lifestreams.utils import chunks, get_setting
+
 
 class BasePlugin(object):
+    batch_size = 100
+    related_model = None
+    not_modified = False
+
     def __init__(self, feed):
         self.feed = feed
 
+    @classmethod
+    def prefetch(cls, plugins, workers=1, processes=0):
+        '''
+        Gives plugins the chance to download the documents of several feeds
+        at once before they are updated one by one.
+        '''
+        pass
+
     def update(self):
+        return self.save(self.fetch())
+
+    def fetch(self):
         self.handler = self.get_handler()
-        for item in self.handler.update(**self.get_update_kwargs()):
-            self.create_item(item)
+        return self.handler.update(**self.get_update_kwargs())
+
+    def save(self, entries):
+        created = 0
+        try:
+            for batch in chunks(entries, self.batch_size):
+                created += len(self.save_batch(batch))
+        finally:
+            # Batches are committed as they are saved, also when fetching fails later.
+            if created:
+                bump_version(self.feed.lifestream.name)
+        self.feed.schedule(created)
         return self
 
+    def save_batch(self, entries):
+        pending = []
+        for entry in entries:
+            item = self.build_item(entry)
+            if item is not None:
+                pending.append((entry, item))
+        if not pending:
+            return []
+        items = [pending_item for pending_entry, pending_item in pending]
+        timeline = get_setting('LIFESTREAMS_TIMELINE')
+        with transaction.commit_on_success():
+            Item.objects.bulk_create(items)
+            if self.related_model is not None or timeline:
+                self.assign_pks(items)
+            if timeline:
+                TimelineEntry.create_for(self.feed, items)
+            if self.related_model is not None:
+                related = [self.build_related(pending_entry, pending_item) for pending_entry, pending_item in pending]
+                self.related_model.objects.bulk_create(related)
+            self.update_last_entry(pending)
+        return items
+
+    def update_last_entry(self, pending):
+        entry, item = max(pending, key=lambda pair: pair[1].published)
+        if self.feed.last_published is not None and item.published <= self.feed.last_published:
+            return
+        last_id = self.get_entry_id(entry)
+        self.feed.last_id = last_id is not None and unicode(last_id) or ''
+        self.feed.last_published = item.published
+        Feed.objects.filter(pk=self.feed.pk).update(last_id=self.feed.last_id,
+                                                    last_published=self.feed.last_published)
+
+    def assign_pks(self, items):
+        # bulk_create doesn't set primary keys, links are unique enough within a feed.
+        links = [item.link for item in items]
+        pks = dict(self.feed.items.filter(link__in=links).order_by('pk').values_list('link', 'pk'))
+        for item in items:
+            item.pk = pks[item.link]
+
+    def get_related_name(self):
+        return self.related_model._meta.get_field('item').related.get_accessor_name()
+
+    def create_item(self, entry):
+        self.save([entry])
+
+    def get_entry_id(self, entry):
+        return None
+
     def get_handler(self):
         raise NotImplementedError("Subclassing BasePlugin must implement get_handler method.")
 
-    def create_item(self, item):
-        raise NotImplementedError("Subclassing BasePlugin must implement create_item method.")
+    def build_item(self, entry):
+        raise NotImplementedError("Subclassing BasePlugin must implement build_item method.")
+
+    def build_related(self, entry, item):
+        raise NotImplementedError("Subclassing BasePlugin with related_model must implement build_related method.")
 
     def get_update_kwargs(self):
         raise NotImplementedError("Subclassing BasePlugin must implement get_update_kwargs method.")
@@ -5,6 +5,8 @@ from django.utils.translation import ugettext_lazy as _
 class InstagramFeed(models.Model):
     feed = models.OneToOneField('lifestreams.Feed', related_name='instagram', verbose_name=_('Feed'))
     access_token = models.CharField(_('Access Token'), max_length=255)
+    backfill_min_id = models.CharField(_('Backfill min ID'), max_length=100, blank=True)
+    backfill_max_id = models.CharField(_('Backfill max ID'), max_length=100, blank=True)
 
     def __unicode__(self):
         return unicode(self.feed)
@@ -6,7 +6,10 @@ from django.core.exceptions import ImproperlyConfigured
 import pytz
 from instagram import client, InstagramAPIError, InstagramClientError
 
+from lifestreams.models import Item
+from lifestreams.clients import client_cache
 from lifestreams.plugins import BasePlugin
+from lifestreams.utils import get_setting
 from lifestreams.exceptions import FeedNotConfiguredException, FeedErrorException
 
 from .models import InstagramFeed, ItemMedia
@@ -25,12 +28,25 @@ if APP_NAME not in settings.INSTALLED_APPS:  # pragma: no cover
 class InstagramHandler(object):
 
     def __init__(self, access_token):
-        self.api = client.InstagramAPI(access_token=access_token)
+        self.api = client_cache.get_or_create(('instagram', access_token),
+                                              lambda: client.InstagramAPI(access_token=access_token))
+        self.max_pages = get_setting('LIFESTREAMS_INSTAGRAM_MAX_PAGES')
+        self.complete = True
 
     def update(self, **kwargs):
+        '''
+        Follows the pagination of the recent media, newest first, for up to
+        max_pages pages. min_id and max_id are exclusive, complete tells if
+        the last page was reached.
+        '''
+        bounds = (kwargs.get('min_id'), kwargs.get('max_id'))
         try:
-            media, next = self.api.user_recent_media(**kwargs)
-            return media[:-1] if 'min_id' in kwargs else media
+            pages = self.api.user_recent_media(as_generator=True, max_pages=self.max_pages, **kwargs)
+            for media, next_url in pages:
+                self.complete = not next_url
+                for entry in media:
+                    if entry.id not in bounds:
+                        yield entry
         except InstagramAPIError, e:
             logger.warn(
                 "InstagramAPIError, %s-%s", e.error_type, e.error_message)
@@ -44,31 +60,71 @@ class InstagramPlugin(BasePlugin):
 
     '''
     '''
+    related_model = ItemMedia
+    instagram_feed = None
 
     def get_handler(self):
         try:
-            instagram = self.feed.instagram
-            return InstagramHandler(access_token=instagram.access_token)
+            self.instagram_feed = self.feed.instagram
+            return InstagramHandler(access_token=self.instagram_feed.access_token)
         except InstagramFeed.DoesNotExist:
             raise FeedNotConfiguredException
 
-    def create_item(self, media):
-        item = self.feed.items.create(
-            published=pytz.UTC.localize(media.created_time),
-            content=media.get_standard_resolution_url(
-            ),
-            author=media.user.username,
-            link=media.link)
+    def save(self, media):
+        super(InstagramPlugin, self).save(media)
+        if self.instagram_feed is not None and self.handler.complete:
+            self.save_checkpoint('')
+        return self
+
+    def save_batch(self, media):
+        items = super(InstagramPlugin, self).save_batch(media)
+        if self.instagram_feed is not None and media:
+            # Media come newest first, everything newer than the last one is stored.
+            self.save_checkpoint(media[-1].id)
+        return items
+
+    def save_checkpoint(self, max_id):
+        min_id = max_id and self.min_id or ''
+        instagram_feed = self.instagram_feed
+        if (min_id, max_id) != (instagram_feed.backfill_min_id, instagram_feed.backfill_max_id):
+            instagram_feed.backfill_min_id, instagram_feed.backfill_max_id = min_id, max_id
+            InstagramFeed.objects.filter(pk=instagram_feed.pk).update(backfill_min_id=min_id,
+                                                                      backfill_max_id=max_id)
+
+    def build_item(self, media):
+        return Item(feed=self.feed,
+                    published=pytz.UTC.localize(media.created_time),
+                    content=media.get_standard_resolution_url(),
+                    author=media.user.username,
+                    link=media.link)
+
+    def build_related(self, media, item):
         caption = media.caption and media.caption.text or ''
-        ItemMedia.objects.create(
-            item=item, instagram_id=media.id, caption=caption)
+        return ItemMedia(item=item, instagram_id=media.id, caption=caption)
+
+    def get_entry_id(self, media):
+        return media.id
 
     def get_update_kwargs(self):
+        if self.instagram_feed is not None and self.instagram_feed.backfill_max_id:
+            self.min_id = self.instagram_feed.backfill_min_id
+            kwargs = {'max_id': self.instagram_feed.backfill_max_id}
+            if self.min_id:
+                kwargs['min_id'] = self.min_id
+            return kwargs
+        self.min_id = self.get_last_id()
+        if self.min_id:
+            return {'min_id': self.min_id}
+        return {}
+
+    def get_last_id(self):
+        if self.feed.last_id:
+            return self.feed.last_id
         try:
             item = self.feed.items.latest('published')
         except self.feed.items.model.DoesNotExist:
-            return {}
-        return {'min_id': item.instagram.instagram_id}
+            return None
+        return item.instagram.instagram_id
 
     def get_template_name(self):
         return 'lifestreams/instagram/item.html'
\ No newline at end of file
@@ -1,12 +1,14 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.utils.timezone import is_aware, now
 
 import pytz
 from mock import patch, Mock
 from instagram import InstagramAPIError, InstagramClientError
 
+from lifestreams.clients import client_cache
 from lifestreams.models import Lifestream, Feed, Item
 from lifestreams.exceptions import FeedNotConfiguredException, FeedErrorException
 
@@ -14,12 +16,51 @@ from .plugin import InstagramPlugin, InstagramHandler
 from .models import InstagramFeed, ItemMedia
 
 
+class StubAPI(object):
+    '''
+    Stands in for InstagramAPI, paging recent media ids three at a time the
+    way user_recent_media does with as_generator. Bounds are inclusive, like
+    Instagram's. The page number fail_on raises InstagramAPIError.
+    '''
+
+    def __init__(self, ids, fail_on=None):
+        self.ids = sorted(ids, reverse=True)
+        self.fail_on = fail_on
+        self.calls = []
+
+    def user_recent_media(self, as_generator=False, max_pages=3, min_id=None, max_id=None):
+        kwargs = {'max_pages': max_pages}
+        if min_id is not None:
+            kwargs['min_id'] = min_id
+        if max_id is not None:
+            kwargs['max_id'] = max_id
+        self.calls.append(kwargs)
+        ids = [media_id for media_id in self.ids
+               if (min_id is None or media_id >= int(min_id.split('_')[0])) and
+                  (max_id is None or media_id <= int(max_id.split('_')[0]))]
+        pages = [ids[i:i + 3] for i in range(0, len(ids), 3)]
+        for number, page in enumerate(pages[:max_pages]):
+            if number + 1 == self.fail_on:
+                raise InstagramAPIError(400, 'error_type', 'error_message')
+            next_url = number + 1 < len(pages) and 'https://api.instagram.com/next' or None
+            yield [self.get_media(media_id) for media_id in page], next_url
+
+    def get_media(self, media_id):
+        media = Mock(id='%d_1' % media_id, link='http://instagram.com/p/%d/' % media_id,
+                     created_time=datetime(2013, 1, 1) + timedelta(minutes=media_id))
+        media.caption.text = 'media %d' % media_id
+        media.user.username = 'uniquisimo'
+        return media
+
+
 class PluginTest(TestCase):
     def setUp(self):
         feed_plugin = 'lifestreams.plugins.lifestream_instagram.plugin.InstagramPlugin'
         lifestream = Lifestream.objects.create(name='lifestream')
         self.feed = Feed(title=feed_plugin, feed_plugin=feed_plugin, lifestream=lifestream)
         self.feed.save()
+        client_cache.clear()
+        self.addCleanup(client_cache.clear)
 
     @patch('lifestreams.plugins.lifestream_instagram.plugin.InstagramHandler')
     def test_get_handler_call_handler(self, InstagramHandler):
@@ -47,6 +88,7 @@ class PluginTest(TestCase):
         handler = get_handler.return_value
         media = Mock()
         media.created_time = datetime.now()
+        media.link = 'http://instagram.com/p/a/'
         handler.update.return_value = [media]
         plugin = InstagramPlugin(feed=self.feed)
 
@@ -65,6 +107,7 @@ class PluginTest(TestCase):
         media = Mock()
         media.created_time = datetime.now()
         media.caption = None
+        media.link = 'http://instagram.com/p/a/'
         handler.update.return_value = [media]
         plugin = InstagramPlugin(feed=self.feed)
 
@@ -94,6 +137,28 @@ class PluginTest(TestCase):
 
         self.assertEqual({'min_id': '2'}, kwargs)
 
+    def test_get_update_kwargs_from_feed(self):
+        self.feed.last_id = '1234_1'
+        plugin = InstagramPlugin(feed=self.feed)
+
+        with self.assertNumQueries(0):
+            kwargs = plugin.get_update_kwargs()
+
+        self.assertEqual({'min_id': '1234_1'}, kwargs)
+
+    @patch('lifestreams.plugins.lifestream_instagram.plugin.InstagramPlugin.get_handler')
+    def test_update_stores_last_id(self, get_handler):
+        media = Mock()
+        media.id = '1234_1'
+        media.created_time = datetime.now()
+        media.link = 'http://instagram.com/p/a/'
+        get_handler.return_value.update.return_value = [media]
+        plugin = InstagramPlugin(feed=self.feed)
+
+        plugin.update()
+
+        self.assertEqual({'min_id': '1234_1'}, InstagramPlugin(feed=Feed.objects.get()).get_update_kwargs())
+
     def assert_compare_media_item(self, media, item):
         self.assertEqual(unicode(media.get_standard_resolution_url.return_value), item.content)
         self.assertEqual(unicode(media.user.username), item.author)
@@ -105,6 +170,31 @@ class PluginTest(TestCase):
         self.assertEqual(unicode(media.link), item.link)
         self.assertTrue(is_aware(item.published))
 
+    @patch('instagram.client.InstagramAPI')
+    @override_settings(LIFESTREAMS_INSTAGRAM_MAX_PAGES=2)
+    def test_update_catches_up_across_runs(self, InstagramAPI):
+        instagram_feed = InstagramFeed.objects.create(feed=self.feed, access_token='access_token')
+        InstagramAPI.return_value = StubAPI(range(1, 4))
+        InstagramPlugin(feed=self.feed).update()
+        InstagramAPI.return_value = StubAPI(range(1, 11))
+        client_cache.clear()
+
+        InstagramPlugin(feed=Feed.objects.get(pk=self.feed.pk)).update()
+
+        self.assertEqual(9, self.feed.items.count())
+        instagram_feed = InstagramFeed.objects.get(pk=instagram_feed.pk)
+        self.assertEqual(('3_1', '5_1'), (instagram_feed.backfill_min_id, instagram_feed.backfill_max_id))
+        self.assertEqual('10_1', Feed.objects.get(pk=self.feed.pk).last_id)
+
+        InstagramPlugin(feed=Feed.objects.get(pk=self.feed.pk)).update()
+
+        self.assertEqual([{'max_pages': 2, 'min_id': '3_1', 'max_id': '5_1'}], InstagramAPI.return_value.calls[-1:])
+        self.assertEqual(10, self.feed.items.count())
+        instagram_feed = InstagramFeed.objects.get(pk=instagram_feed.pk)
+        self.assertEqual(('', ''), (instagram_feed.backfill_min_id, instagram_feed.backfill_max_id))
+        self.assertEqual(['%d_1' % i for i in range(10, 0, -1)],
+                         list(ItemMedia.objects.order_by('-item__published').values_list('instagram_id', flat=True)))
+
     def test_get_template_name(self):
         feed = Mock()
         plugin = InstagramPlugin(feed=feed)
@@ -116,6 +206,8 @@ class PluginTest(TestCase):
 class InstagramHandlerTest(TestCase):
     def setUp(self):
         self.access_token = 'a'
+        client_cache.clear()
+        self.addCleanup(client_cache.clear)
 
     @patch('instagram.client.InstagramAPI')
     def test_initialize(self, InstagramAPI):
@@ -123,47 +215,83 @@ class InstagramHandlerTest(TestCase):
 
         InstagramAPI.assert_called_once_with(access_token=self.access_token)
 
+    @patch('instagram.client.InstagramAPI')
+    def test_api_shared_by_access_token(self, InstagramAPI):
+        handler = InstagramHandler(access_token=self.access_token)
+        other = InstagramHandler(access_token=self.access_token)
+        InstagramAPI.return_value = Mock()
+        another = InstagramHandler(access_token='b')
+
+        self.assertIs(handler.api, other.api)
+        self.assertIsNot(handler.api, another.api)
+        self.assertEqual(2, InstagramAPI.call_count)
+
     @patch('instagram.client.InstagramAPI')
     def test_update(self, InstagramAPI):
+        api = InstagramAPI.return_value = StubAPI(range(1, 8))
         handler = InstagramHandler(access_token=self.access_token)
-        api = InstagramAPI.return_value
-        api.user_recent_media.return_value = (Mock(), Mock())
 
-        result = handler.update()
+        result = [media.id for media in handler.update()]
 
-        api.user_recent_media.assert_called_once_with()
-        self.assertEqual(api.user_recent_media.return_value[0], result)
+        self.assertEqual(['%d_1' % i for i in range(7, 0, -1)], result)
+        self.assertEqual([{'max_pages': 20}], api.calls)
+        self.assertTrue(handler.complete)
 
     @patch('instagram.client.InstagramAPI')
-    def test_update_since_id(self, InstagramAPI):
+    def test_update_min_id_exclusive(self, InstagramAPI):
+        api = InstagramAPI.return_value = StubAPI(range(1, 8))
+        handler = InstagramHandler(access_token=self.access_token)
+
+        result = [media.id for media in handler.update(min_id='3_1')]
+
+        self.assertEqual(['7_1', '6_1', '5_1', '4_1'], result)
+        self.assertEqual([{'max_pages': 20, 'min_id': '3_1'}], api.calls)
+
+    @patch('instagram.client.InstagramAPI')
+    def test_update_max_id_exclusive(self, InstagramAPI):
+        InstagramAPI.return_value = StubAPI(range(1, 8))
         handler = InstagramHandler(access_token=self.access_token)
-        api = InstagramAPI.return_value
-        api.user_recent_media.return_value = ([Mock(), Mock()], Mock())
 
-        result = handler.update(min_id=1)
+        result = [media.id for media in handler.update(min_id='3_1', max_id='6_1')]
 
-        api.user_recent_media.assert_called_once_with(min_id=1)
-        self.assertEqual(api.user_recent_media.return_value[0][:-1], result)
+        self.assertEqual(['5_1', '4_1'], result)
+
+    @patch('instagram.client.InstagramAPI')
+    @override_settings(LIFESTREAMS_INSTAGRAM_MAX_PAGES=2)
+    def test_update_max_pages(self, InstagramAPI):
+        InstagramAPI.return_value = StubAPI(range(1, 8))
+        handler = InstagramHandler(access_token=self.access_token)
+
+        result = [media.id for media in handler.update()]
+
+        self.assertEqual(['7_1', '6_1', '5_1', '4_1', '3_1', '2_1'], result)
+        self.assertFalse(handler.complete)
 
     @patch('instagram.client.InstagramAPI')
     def test_update_with_api_error(self, InstagramAPI):
         handler = InstagramHandler(access_token=self.access_token)
         api = InstagramAPI.return_value
-        api.user_recent_media.return_value = (Mock(), Mock())
         api.user_recent_media.side_effect = InstagramAPIError(400, 'error_type', 'error_message')
 
-        self.assertRaises(FeedErrorException, handler.update)
+        self.assertRaises(FeedErrorException, list, handler.update())
 
-        api.user_recent_media.assert_called_once_with()
+        api.user_recent_media.assert_called_once_with(as_generator=True, max_pages=20)
 
-    
     @patch('instagram.client.InstagramAPI')
     def test_update_with_client_error(self, InstagramAPI):
         handler = InstagramHandler(access_token=self.access_token)
         api = InstagramAPI.return_value
-        api.user_recent_media.return_value = (Mock(), Mock())
         api.user_recent_media.side_effect = InstagramClientError('client_error_message')
 
-        self.assertRaises(FeedErrorException, handler.update)
+        self.assertRaises(FeedErrorException, list, handler.update())
+
+        api.user_recent_media.assert_called_once_with(as_generator=True, max_pages=20)
+
+    @patch('instagram.client.InstagramAPI')
+    def test_update_error_on_later_page(self, InstagramAPI):
+        InstagramAPI.return_value = StubAPI(range(1, 8), fail_on=2)
+        handler = InstagramHandler(access_token=self.access_token)
+        media = handler.update()
 
-        api.user_recent_media.assert_called_once_with()
+        self.assertEqual(['7_1', '6_1', '5_1'], [next(media).id for i in range(3)])
+        self.assertRaises(FeedErrorException, next, media)
@@ -0,0 +1,301 @@
+import httplib
+import logging
+import socket
+import threading
+import time
+import zlib
+from collections import namedtuple
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+from urlparse import urljoin, urlsplit
+
+import feedparser
+
+from lifestreams.utils import get_setting
+
+__all__ = ['ConnectionPool', 'Fetcher', 'FetchError', 'Response', 'Entry', 'connection_pool',
+           'parse_response', 'parse_responses']
+
+logger = logging.getLogger(__name__)
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+Entry = namedtuple('Entry', 'link summary published')
+
+
+class Response(object):
+    '''
+    A downloaded feed document, parsed on demand with feedparser unless it
+    was already parsed by parse_responses.
+    '''
+
+    def __init__(self, url, status=None, body=None, headers=None, error=None):
+        self.url = url
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+        self.error = error
+        self.data = None
+
+    def parse(self):
+        if self.data is not None:
+            return self.data
+        if self.status == 304:
+            return feedparser.FeedParserDict(status=304, feed={}, entries=[])
+        data = feedparser.parse(StringIO(self.body), response_headers=self.headers)
+        data['status'] = self.status
+        return data
+
+
+class FetchError(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    '''
+    Keeps HTTP connections alive between requests to the same host. At most
+    per_host connections to a host are in use at once, idle ones are reused
+    by the next request. Counts requests, connections and time spent.
+    '''
+
+    def __init__(self, per_host=None, timeout=30, max_redirects=5):
+        self.per_host = per_host
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.semaphores = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'requests': 0, 'connections': 0, 'reused': 0, 'seconds': 0.0}
+
+    def open(self, url, headers=None):
+        '''
+        Sends a GET following redirects, returns a PooledResponse that must be
+        closed to give the connection back.
+        '''
+        for redirect in range(self.max_redirects + 1):
+            response = self.send(url, headers or {})
+            location = response.getheader('location')
+            if response.status not in REDIRECT_STATUSES or not location:
+                return response
+            response.close()
+            url = urljoin(url, location)
+        raise FetchError('Too many redirects')
+
+    def send(self, url, headers):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = (parts.path or '/') + (parts.query and '?' + parts.query or '')
+        semaphore = self.get_semaphore(key)
+        semaphore.acquire()
+        try:
+            start = time.time()
+            connection = self.get_connection(key)
+            try:
+                response = self.request(connection, path, headers)
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if not connection.reused:
+                    raise
+                # The server dropped the idle connection, retry on a new one.
+                connection = self.get_connection(key, reuse=False)
+                response = self.request(connection, path, headers)
+        except:
+            semaphore.release()
+            raise
+        return PooledResponse(self, key, connection, response, semaphore, start)
+
+    def request(self, connection, path, headers):
+        connection.request('GET', path, headers=headers)
+        return connection.getresponse()
+
+    def get_connection(self, key, reuse=True):
+        with self.lock:
+            self.stats['requests'] += 1
+            idle = self.idle.get(key)
+            if reuse and idle:
+                self.stats['reused'] += 1
+                return idle.pop()
+            self.stats['connections'] += 1
+        scheme, host = key
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(host, timeout=self.timeout)
+        elif scheme == 'http':
+            connection = httplib.HTTPConnection(host, timeout=self.timeout)
+        else:
+            raise FetchError('Unsupported scheme %s' % scheme)
+        connection.reused = False
+        return connection
+
+    def release(self, key, connection, seconds, reusable):
+        with self.lock:
+            self.stats['seconds'] += seconds
+            if reusable:
+                connection.reused = True
+                self.idle.setdefault(key, []).append(connection)
+        if not reusable:
+            connection.close()
+
+    def get_semaphore(self, key):
+        with self.lock:
+            if key not in self.semaphores:
+                per_host = self.per_host or get_setting('LIFESTREAMS_RSS_CONNECTIONS_PER_HOST')
+                self.semaphores[key] = threading.BoundedSemaphore(per_host)
+            return self.semaphores[key]
+
+    def close_idle(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def report(self):
+        with self.lock:
+            stats = dict(self.stats)
+        logger.info('%(requests)d feed requests on %(connections)d connections, %(reused)d reused, '
+                    '%(seconds).2f seconds fetching.', stats)
+        return stats
+
+
+class PooledResponse(object):
+    '''
+    A response read from a pooled connection. The connection goes back to
+    the pool on close if the body was read to the end.
+    '''
+
+    def __init__(self, pool, key, connection, response, semaphore, start):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.semaphore = semaphore
+        self.start = start
+        self.status = response.status
+        self.headers = dict(response.getheaders())
+        self.closed = False
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.response.read()
+        return self.response.read(size)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if not self.response.isclosed() and self.response.length == 0:
+            self.response.read()
+        reusable = self.response.isclosed() and not self.response.will_close
+        self.response.close()
+        self.pool.release(self.key, self.connection, time.time() - self.start, reusable)
+        self.semaphore.release()
+
+
+connection_pool = ConnectionPool()
+
+
+class Fetcher(object):
+    '''
+    Downloads feed documents concurrently through a connection pool, the
+    shared one by default. At most `workers` requests are in flight at once.
+    '''
+
+    def __init__(self, workers=10, pool=None):
+        self.workers = workers
+        self.pool = pool or connection_pool
+
+    def fetch_all(self, requests):
+        '''
+        Fetches (url, etag, modified) requests, returns their responses in order.
+        '''
+        pool = ThreadPool(self.workers)
+        try:
+            return pool.map(self.__fetch, requests)
+        finally:
+            pool.close()
+            pool.join()
+
+    def fetch(self, url, etag=None, modified=None):
+        try:
+            response = self.pool.open(url, self.get_headers(etag, modified))
+            try:
+                body = decode_body(response.read(), response.getheader('content-encoding'))
+            finally:
+                response.close()
+        except Exception, e:
+            logger.warn('Error fetching %s, %s', url, e)
+            return Response(url, error=e)
+        if response.status == 304:
+            return Response(url, status=304, headers=response.headers)
+        if response.status >= 400:
+            logger.warn('HTTPError fetching %s, %s', url, response.status)
+            return Response(url, status=response.status, error=FetchError(response.status))
+        # The body is decoded already, feedparser would try to decode it again.
+        headers = dict(response.headers)
+        headers.pop('content-encoding', None)
+        return Response(url, status=response.status, body=body, headers=headers)
+
+    def get_headers(self, etag=None, modified=None):
+        headers = {'User-Agent': feedparser.USER_AGENT,
+                   'Accept': feedparser.ACCEPT_HEADER,
+                   'Accept-Encoding': 'gzip, deflate'}
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+        return headers
+
+    def __fetch(self, request):
+        return self.fetch(*request)
+
+
+def decode_body(body, encoding):
+    if encoding == 'gzip':
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+def parse_response(response):
+    '''
+    Parses a response keeping only the fields RSSPlugin stores, so the result
+    is cheap to send back from another process.
+    '''
+    data = response.parse()
+    feed = feedparser.FeedParserDict()
+    if 'title' in data.feed:
+        feed['title'] = data.feed.title
+    entries = [Entry(entry.get('link'), entry.get('summary'), entry.get('published'))
+               for entry in data.entries]
+    return feedparser.FeedParserDict(status=data.get('status'), etag=data.get('etag'),
+                                     modified=data.get('modified'), feed=feed, entries=entries)
+
+
+def parse_responses(responses, processes):
+    '''
+    Parses the downloaded responses on a pool of processes, bodies are
+    released once parsed.
+    '''
+    responses = [response for response in responses if response.error is None]
+    pool = Pool(processes)
+    try:
+        documents = pool.map(parse_response, responses)
+    finally:
+        pool.close()
+        pool.join()
+    for response, data in zip(responses, documents):
+        response.data = data
+        response.body = None
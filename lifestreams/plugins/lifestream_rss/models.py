@@ -5,6 +5,10 @@ from django.utils.translation import ugettext_lazy as _
 class RSSFeed(models.Model):
     feed = models.OneToOneField('lifestreams.Feed', related_name='rss', verbose_name=_('Feed'))
     url = models.URLField(_('URL'))
+    etag = models.CharField(_('ETag'), max_length=255, blank=True)
+    modified = models.CharField(_('Last Modified'), max_length=100, blank=True)
+    incremental = models.BooleanField(_('Incremental parsing'), default=False,
+                                      help_text=_('Parse the feed while it downloads, for very large feeds.'))
 
     def __unicode__(self):
         return unicode(self.feed)
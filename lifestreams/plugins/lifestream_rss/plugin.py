@@ -1,15 +1,23 @@
+import httplib
 import logging
+import socket
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.dispatch import receiver
+from django.utils.timezone import get_default_timezone, is_aware, is_naive, make_aware, make_naive
 
+from lifestreams.models import Item
 from lifestreams.plugins import BasePlugin
 from lifestreams.exceptions import FeedNotConfiguredException, FeedErrorException
+from lifestreams.signals import update_started, update_finished
+from lifestreams.utils import get_setting
 
-import feedparser
 import dateutil.parser
 
+from .fetcher import Fetcher, connection_pool, parse_responses
 from .models import RSSFeed
+from .stream import StreamParser
 
 __all__ = ['RSSHandler', 'RSSPlugin']
 
@@ -24,43 +32,237 @@ if APP_NAME not in settings.INSTALLED_APPS:  # pragma: no cover
 
 class RSSHandler(object):
 
-    def __init__(self, url):
+    def __init__(self, url, etag=None, modified=None, response=None, incremental=False, max_entries=None):
         self.url = url
+        self.etag = etag
+        self.modified = modified
+        self.response = response
+        self.incremental = incremental
+        self.max_entries = max_entries
+        self.not_modified = False
+        self.title = None
 
     def update(self):
+        if self.incremental and self.response is None:
+            return self.stream()
         try:
-            data = feedparser.parse(self.url)
+            data = self.parse()
+            if data.get('status') == 304:
+                self.not_modified = True
+                return []
+            self.etag = data.get('etag')
+            self.modified = data.get('modified')
             self.title = self.get_title(data)
             return data.entries
         except AttributeError:
             raise FeedErrorException
 
+    def parse(self):
+        if self.response is None:
+            self.response = Fetcher().fetch(self.url, self.etag, self.modified)
+        if self.response.error is not None:
+            raise FeedErrorException
+        return self.response.parse()
+
     def get_title(self, data):
         return data.feed.title
 
+    def stream(self):
+        '''
+        Downloads and parses the document at the same pace the entries are
+        consumed, so only the current entry is held in memory.
+        '''
+        headers = Fetcher().get_headers(self.etag, self.modified)
+        # The document is parsed straight from the socket, it can't be gzipped.
+        del headers['Accept-Encoding']
+        try:
+            response = connection_pool.open(self.url, headers)
+        except Exception, e:
+            logger.warn('Error fetching %s, %s', self.url, e)
+            raise FeedErrorException
+        if response.status == 304 or response.status >= 400:
+            response.close()
+            if response.status >= 400:
+                raise FeedErrorException
+            self.not_modified = True
+            return []
+        self.etag = response.getheader('etag')
+        self.modified = response.getheader('last-modified')
+        return self.iter_entries(response)
+
+    def iter_entries(self, response):
+        parser = StreamParser(response)
+        try:
+            for position, entry in enumerate(parser):
+                if position == self.max_entries:
+                    break
+                if position == 0:
+                    if parser.title is None:
+                        raise FeedErrorException
+                    self.title = parser.title
+                yield entry
+        except SyntaxError:
+            raise FeedErrorException
+        except (socket.error, httplib.HTTPException), e:
+            logger.warn('Error reading %s, %s', self.url, e)
+            raise FeedErrorException
+        finally:
+            response.close()
+
+
+@receiver(update_started)
+def reset_connection_stats(sender, **kwargs):
+    connection_pool.reset_stats()
+
+
+@receiver(update_finished)
+def report_connections(sender, **kwargs):
+    connection_pool.report()
+    connection_pool.close_idle()
+
 
 class RSSPlugin(BasePlugin):
+    response = None
+
+    @classmethod
+    def prefetch(cls, plugins, workers=1, processes=0):
+        rss_feeds = RSSFeed.objects.filter(feed__in=[plugin.feed.pk for plugin in plugins])
+        rss_feeds = dict((rss_feed.feed_id, rss_feed) for rss_feed in rss_feeds)
+        # Incremental feeds are streamed when updated, not downloaded upfront.
+        plugins = [plugin for plugin in plugins
+                   if plugin.feed.pk in rss_feeds and not rss_feeds[plugin.feed.pk].incremental]
+        for plugin in plugins:
+            plugin.rss_feed = rss_feeds[plugin.feed.pk]
+        fetcher = Fetcher(workers=workers)
+        requests = [(plugin.rss_feed.url, plugin.rss_feed.etag or None, plugin.rss_feed.modified or None)
+                    for plugin in plugins]
+        responses = fetcher.fetch_all(requests)
+        if processes:
+            parse_responses(responses, processes)
+        for plugin, response in zip(plugins, responses):
+            plugin.response = response
 
     def get_handler(self):
         try:
             self.rss_feed = self.feed.rss
-            return RSSHandler(url=self.rss_feed.url)
+            return RSSHandler(url=self.rss_feed.url,
+                              etag=self.rss_feed.etag or None,
+                              modified=self.rss_feed.modified or None,
+                              response=self.response,
+                              incremental=self.rss_feed.incremental,
+                              max_entries=get_setting('LIFESTREAMS_RSS_MAX_ENTRIES'))
         except RSSFeed.DoesNotExist:
             raise FeedNotConfiguredException
 
-    def create_item(self, entry):
-        if self.include_entry(entry):
+    def fetch(self):
+        entries = super(RSSPlugin, self).fetch()
+        self.not_modified = self.handler.not_modified
+        return entries
+
+    def save(self, entries):
+        if isinstance(entries, list):
+            entries = self.skip_ingested(entries)
+        else:
+            entries = self.iter_new_entries(entries)
+        super(RSSPlugin, self).save(entries)
+        if not self.not_modified:
+            self.save_validators()
+        return self
+
+    def skip_ingested(self, entries):
+        '''
+        In newest first feeds, drops the entries from the last ingested one on.
+        Other feeds are left to the duplicate check.
+        '''
+        if self.feed.last_published is None or not entries:
+            return entries
+        published = [self.get_published(entry) for entry in entries]
+        if None in published or sorted(published, reverse=True) != published:
+            return entries
+        position = 0
+        for entry, entry_published in zip(entries, published):
+            if self.is_ingested(entry, entry_published):
+                break
+            position += 1
+        if position < len(entries):
+            logger.info('Feed %s<%d> skipped %d already ingested entries.',
+                        self.feed, self.feed.id, len(entries) - position)
+        return entries[:position]
+
+    def iter_new_entries(self, entries):
+        '''
+        Lazy skip_ingested for streamed feeds, stops at the last ingested entry
+        as long as the entries read so far are newest first.
+        '''
+        ordered = self.feed.last_published is not None
+        previous = None
+        for entry in entries:
+            if ordered:
+                published = self.get_published(entry)
+                if published is None or (previous is not None and published > previous):
+                    ordered = False
+                elif self.is_ingested(entry, published):
+                    logger.info('Feed %s<%d> stopped at the last ingested entry.', self.feed, self.feed.id)
+                    return
+                previous = published
+            yield entry
+
+    def is_ingested(self, entry, published):
+        '''
+        Whether entries from this one on were ingested. Entries published at
+        the same time as the last ingested one can be new, they are left to
+        the duplicate check.
+        '''
+        if published == self.feed.last_published:
+            return False
+        return published < self.feed.last_published or entry.link == self.feed.last_id
+
+    def get_published(self, entry):
+        try:
             published = dateutil.parser.parse(entry.published)
-            self.feed.items.create(published=published,
-                                   content=entry.summary,
-                                   author=self.handler.title,
-                                   link=entry.link)
+        except (AttributeError, TypeError, ValueError):
+            return None
+        if settings.USE_TZ and is_naive(published):
+            return make_aware(published, get_default_timezone())
+        if not settings.USE_TZ and is_aware(published):
+            return make_naive(published, get_default_timezone())
+        return published
+
+    def save_validators(self):
+        etag = self.handler.etag or ''
+        modified = self.handler.modified or ''
+        if (etag, modified) != (self.rss_feed.etag, self.rss_feed.modified):
+            self.rss_feed.etag, self.rss_feed.modified = etag, modified
+            RSSFeed.objects.filter(pk=self.rss_feed.pk).update(etag=etag, modified=modified)
+
+    def build_item(self, entry):
+        published = self.get_published(entry)
+        if published is not None and self.include_entry(entry):
+            return Item(feed=self.feed,
+                        published=published,
+                        content=entry.summary,
+                        author=self.handler.title,
+                        link=entry.link)
+
+    def get_entry_id(self, entry):
+        return entry.link
 
     def get_update_kwargs(self):
         return {}
 
+    def save_batch(self, entries):
+        self.known_links = self.get_known_links(entries)
+        return super(RSSPlugin, self).save_batch(entries)
+
+    def get_known_links(self, entries):
+        links = [entry.link for entry in entries]
+        return set(self.feed.items.filter(link__in=links).values_list('link', flat=True))
+
     def include_entry(self, entry):
-        return not self.feed.items.filter(link=entry.link).exists()
+        if entry.link in self.known_links:
+            return False
+        self.known_links.add(entry.link)
+        return True
 
     def get_template_name(self):
         return 'lifestreams/rss/item.html'
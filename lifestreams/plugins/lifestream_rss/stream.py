@@ -0,0 +1,64 @@
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:  # pragma: no cover
+    from xml.etree.ElementTree import iterparse
+
+import feedparser
+
+from .fetcher import Entry
+
+__all__ = ['StreamParser']
+
+ENTRY_TAGS = ('item', 'entry')
+SUMMARY_TAGS = ('description', 'summary', 'encoded', 'content')
+PUBLISHED_TAGS = ('pubDate', 'published', 'date', 'updated')
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+class StreamParser(object):
+    '''
+    Reads RSS and Atom documents incrementally, yielding an Entry as soon as
+    each item is parsed and discarding its elements afterwards. The feed
+    title is available once the first entry has been yielded.
+    '''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.title = None
+
+    def __iter__(self):
+        parents = []
+        in_entry = False
+        for event, element in iterparse(self.stream, events=('start', 'end')):
+            name = local_name(element.tag)
+            if event == 'start':
+                parents.append(element)
+                in_entry = in_entry or name in ENTRY_TAGS
+                continue
+            parents.pop()
+            if name in ENTRY_TAGS:
+                in_entry = False
+                entry = self.build_entry(element)
+                if parents:
+                    parents[-1].remove(element)
+                yield entry
+            elif name == 'title' and not in_entry and self.title is None and len(parents) <= 2:
+                self.title = (element.text or '').strip()
+
+    def build_entry(self, element):
+        link = summary = published = None
+        for child in element:
+            name = local_name(child.tag)
+            if name == 'link' and link is None:
+                if child.get('href') and child.get('rel', 'alternate') == 'alternate':
+                    link = child.get('href')
+                elif child.text:
+                    link = child.text.strip()
+            elif name in SUMMARY_TAGS and summary is None and child.text:
+                summary = feedparser._sanitizeHTML(child.text, 'utf-8', 'text/html')
+            elif name in PUBLISHED_TAGS and published is None and child.text:
+                published = child.text.strip()
+        return Entry(link, summary or '', published)
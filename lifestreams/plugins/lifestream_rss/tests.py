@@ -1,8 +1,19 @@
+import gzip
+import socket
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+
+from django.core.management import call_command
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.utils.timezone import now
 
 from mock import patch, Mock
 import dateutil.parser
+import feedparser
 
 from lifestreams.models import Lifestream, Feed, Item
 from lifestreams.exceptions import FeedNotConfiguredException, FeedErrorException
@@ -10,6 +21,9 @@ from lifestreams.exceptions import FeedNotConfiguredException, FeedErrorExceptio
 from .models import RSSFeed
 
 from .plugin import RSSPlugin, RSSHandler
+from .fetcher import (ConnectionPool, Fetcher, FetchError, Response, Entry, connection_pool, decode_body,
+                      parse_response, parse_responses)
+from .stream import StreamParser
 
 
 class PluginTest(TestCase):
@@ -29,7 +43,51 @@ class PluginTest(TestCase):
 
         self.assertEqual(rss_feed, plugin.rss_feed)
         self.assertEqual(RSSHandler.return_value, result)
-        RSSHandler.assert_called_once_with(url=rss_feed.url)
+        RSSHandler.assert_called_once_with(url=rss_feed.url, etag=None, modified=None, response=None,
+                                           incremental=False, max_entries=1000)
+
+    @patch('lifestreams.plugins.lifestream_rss.plugin.RSSHandler')
+    def test_get_handler_call_handler_with_validators(self, RSSHandler):
+        plugin = RSSPlugin(feed=self.feed)
+        rss_feed = RSSFeed.objects.create(feed=self.feed, url='http://iwanttobehacker.tumblr.com/rss',
+                                          etag='"etag"', modified='Tue, 12 Jun 2012 10:43:57 GMT')
+
+        plugin.get_handler()
+
+        RSSHandler.assert_called_once_with(url=rss_feed.url, etag=rss_feed.etag, modified=rss_feed.modified,
+                                           response=None, incremental=False, max_entries=1000)
+
+    @patch('lifestreams.plugins.lifestream_rss.plugin.RSSPlugin.get_handler')
+    def test_update_stores_validators(self, get_handler):
+        rss_feed = RSSFeed.objects.create(feed=self.feed, url='http://uniquisimo.com/rss')
+        handler = get_handler.return_value
+        handler.update.return_value = []
+        handler.not_modified = False
+        handler.etag = '"etag"'
+        handler.modified = 'Tue, 12 Jun 2012 10:43:57 GMT'
+        plugin = RSSPlugin(feed=self.feed)
+        plugin.rss_feed = rss_feed
+
+        plugin.update()
+
+        rss_feed = RSSFeed.objects.get()
+        self.assertEqual('"etag"', rss_feed.etag)
+        self.assertEqual('Tue, 12 Jun 2012 10:43:57 GMT', rss_feed.modified)
+
+    @patch('lifestreams.plugins.lifestream_rss.plugin.RSSPlugin.get_handler')
+    def test_update_not_modified(self, get_handler):
+        rss_feed = RSSFeed.objects.create(feed=self.feed, url='http://uniquisimo.com/rss', etag='"etag"')
+        handler = get_handler.return_value
+        handler.update.return_value = []
+        handler.not_modified = True
+        plugin = RSSPlugin(feed=self.feed)
+        plugin.rss_feed = rss_feed
+
+        with self.assertNumQueries(1):
+            result = plugin.update()
+
+        self.assertTrue(result.not_modified)
+        self.assertEqual('"etag"', RSSFeed.objects.get().etag)
 
     def test_get_handler_call_handler_without_rss(self):
         plugin = RSSPlugin(feed=self.feed)
@@ -87,6 +145,8 @@ class PluginTest(TestCase):
         entry.link = 'http://uniquisimo.com'
         self.feed.items.create(published=now(), link=entry.link)
 
+        plugin.known_links = plugin.get_known_links([entry])
+
         result = plugin.include_entry(entry)
 
         self.assertFalse(result)
@@ -98,6 +158,8 @@ class PluginTest(TestCase):
         entry.link = 'http://uniquisimo.com'
         self.feed.items.create(published=now(), link='http://witoi.com')
 
+        plugin.known_links = plugin.get_known_links([entry])
+
         result = plugin.include_entry(entry)
 
         self.assertTrue(result)
@@ -108,10 +170,140 @@ class PluginTest(TestCase):
         entry.link = 'http://uniquisimo.com'
         entry.published = 'Tue, 12 Jun 2012 10:43:57 -0400'
 
+        plugin.known_links = plugin.get_known_links([entry])
+
         result = plugin.include_entry(entry)
 
         self.assertTrue(result)
 
+    def test_include_entry_repeated(self):
+        plugin = RSSPlugin(feed=self.feed)
+        entry = Mock()
+        entry.link = 'http://uniquisimo.com'
+        plugin.known_links = plugin.get_known_links([entry])
+
+        self.assertTrue(plugin.include_entry(entry))
+        self.assertFalse(plugin.include_entry(entry))
+
+    def test_save_queries_do_not_grow_with_entries(self):
+        plugin = RSSPlugin(feed=self.feed)
+        plugin.rss_feed = RSSFeed.objects.create(feed=self.feed, url='http://uniquisimo.com/rss')
+        plugin.handler = Mock(etag=None, modified=None)
+        for size, published in ((10, 'Tue, 12 Jun 2012 10:43:57 -0400'), (100, 'Wed, 13 Jun 2012 10:43:57 -0400')):
+            entries = self.build_entries(size, published)
+            entries[0].published = 'Mon, 11 Jun 2012 10:43:57 -0400'
+            with self.assertNumQueries(5):
+                plugin.save(entries)
+            with self.assertNumQueries(2):
+                plugin.save(entries)
+
+    def test_save_skips_ingested_entries(self):
+        plugin = RSSPlugin(feed=self.feed)
+        plugin.rss_feed = RSSFeed.objects.create(feed=self.feed, url='http://uniquisimo.com/rss')
+        plugin.handler = Mock(etag=None, modified=None)
+        entries = self.build_entries(4)
+        for i, entry in enumerate(entries):
+            entry.published = 'Tue, %d Jun 2012 10:43:57 -0400' % (12 - i)
+        plugin.save(entries[1:])
+
+        with self.assertNumQueries(5):
+            plugin.save(entries)
+
+        self.assertEqual([entries[0].link], [item.link for item in self.feed.items.all()[:1]])
+        self.assertEqual(4, self.feed.items.count())
+
+    def test_save_skips_all_entries(self):
+        plugin = RSSPlugin(feed=self.feed)
+        plugin.rss_feed = RSSFeed.objects.create(feed=self.feed, url='http://uniquisimo.com/rss')
+        plugin.handler = Mock(etag=None, modified=None)
+        entries = self.build_entries(100)
+        plugin.save(entries)
+
+        # Entries published with the last ingested one go to the duplicate check.
+        with self.assertNumQueries(2):
+            plugin.save(entries)
+
+        self.assertEqual(100, self.feed.items.count())
+
+    def test_save_dates_without_timezone(self):
+        plugin = RSSPlugin(feed=self.feed)
+        plugin.rss_feed = RSSFeed.objects.create(feed=self.feed, url='http://uniquisimo.com/rss')
+        plugin.handler = Mock(etag=None, modified=None)
+        plugin.save(self.build_entries(1))
+        entries = self.build_entries(2, '2013-09-11 10:00:00')
+        entries[1].published = 'Wed, 11 Sep 2013 23:43:57 -0400'
+
+        plugin.save(entries)
+
+        self.assertEqual(3, self.feed.items.count())
+        self.assertEqual(dateutil.parser.parse('Wed, 11 Sep 2013 23:43:57 -0400'),
+                         Feed.objects.get(pk=self.feed.pk).last_published)
+
+    def test_skip_ingested_by_link(self):
+        self.feed.last_id = 'http://uniquisimo.com/2/1'
+        self.feed.last_published = dateutil.parser.parse('Mon, 11 Jun 2012 10:43:57 -0400')
+        plugin = RSSPlugin(feed=self.feed)
+        entries = self.build_entries(2)
+
+        self.assertEqual(entries[:1], plugin.skip_ingested(entries))
+
+    def test_skip_ingested_not_ordered(self):
+        self.feed.last_id = 'http://uniquisimo.com/3/0'
+        self.feed.last_published = dateutil.parser.parse('Tue, 12 Jun 2012 10:43:57 -0400')
+        plugin = RSSPlugin(feed=self.feed)
+        entries = self.build_entries(3)
+        entries[0].published = 'Mon, 11 Jun 2012 10:43:57 -0400'
+
+        self.assertEqual(entries, plugin.skip_ingested(entries))
+
+    def test_skip_ingested_without_dates(self):
+        self.feed.last_published = dateutil.parser.parse('Tue, 12 Jun 2012 10:43:57 -0400')
+        plugin = RSSPlugin(feed=self.feed)
+        entries = self.build_entries(3)
+        entries[1].published = 'not a date'
+
+        self.assertEqual(entries, plugin.skip_ingested(entries))
+
+    def test_skip_ingested_same_date(self):
+        self.feed.last_id = 'http://uniquisimo.com/3/0'
+        self.feed.last_published = dateutil.parser.parse('Tue, 12 Jun 2012 10:43:57 -0400')
+        plugin = RSSPlugin(feed=self.feed)
+        entries = self.build_entries(3)
+        entries[2].published = 'Mon, 11 Jun 2012 10:43:57 -0400'
+
+        self.assertEqual(entries[:2], plugin.skip_ingested(entries))
+        self.assertEqual(entries[:2], list(plugin.iter_new_entries(iter(entries))))
+
+    def test_save_new_entry_with_same_date(self):
+        plugin = RSSPlugin(feed=self.feed)
+        plugin.rss_feed = RSSFeed.objects.create(feed=self.feed, url='http://uniquisimo.com/rss')
+        plugin.handler = Mock(etag=None, modified=None)
+        a, old, b = self.build_entries(3)
+        old.published = 'Mon, 11 Jun 2012 10:43:57 -0400'
+        plugin.save([a, old])
+
+        plugin = RSSPlugin(feed=Feed.objects.get(pk=self.feed.pk))
+        plugin.rss_feed, plugin.handler = RSSFeed.objects.get(feed=self.feed), Mock(etag=None, modified=None)
+        plugin.save([b, a, old])
+
+        self.assertEqual(set([a.link, b.link, old.link]), set(self.feed.items.values_list('link', flat=True)))
+        self.assertEqual(3, self.feed.items.count())
+
+    def test_skip_ingested_new_feed(self):
+        plugin = RSSPlugin(feed=self.feed)
+        entries = self.build_entries(3)
+
+        self.assertEqual(entries, plugin.skip_ingested(entries))
+
+    def build_entries(self, size, published='Tue, 12 Jun 2012 10:43:57 -0400'):
+        entries = []
+        for i in range(size):
+            entry = Mock()
+            entry.published = published
+            entry.link = 'http://uniquisimo.com/%d/%d' % (size, i)
+            entries.append(entry)
+        return entries
+
     def assert_compare_entry_item(self, entry, item, title):
         self.assertEqual(unicode(entry.summary), item.content)
         self.assertEqual(unicode(title), item.author)
@@ -131,29 +323,59 @@ class RSSHandlerTest(TestCase):
     def setUp(self):
         self.url = 'http://uniquisimo.com'
 
-    @patch('feedparser.parse')
-    def test_initialize(self, parse):
+    @patch('lifestreams.plugins.lifestream_rss.plugin.Fetcher')
+    def test_initialize(self, Fetcher):
         handler = RSSHandler(url=self.url)
 
         self.assertEqual(self.url, handler.url)
-        self.assertFalse(parse.called)
+        self.assertFalse(Fetcher.called)
 
-    @patch('feedparser.parse')
+    @patch('lifestreams.plugins.lifestream_rss.plugin.Fetcher')
     @patch('lifestreams.plugins.lifestream_rss.plugin.RSSHandler.get_title')
-    def test_update(self, get_title, parse):
+    def test_update(self, get_title, Fetcher):
         handler = RSSHandler(url=self.url)
-        data = parse.return_value
+        response = Fetcher.return_value.fetch.return_value
+        response.error = None
+        data = response.parse.return_value
         data.entries = [Mock(), Mock()]
 
         result = handler.update()
 
-        parse.assert_called_once_with(self.url)
+        Fetcher.return_value.fetch.assert_called_once_with(self.url, None, None)
         get_title.assert__called_once_with()
         self.assertEqual(data.entries, result)
         self.assertEqual(get_title.return_value, handler.title)
 
-    @patch('feedparser.parse')
-    def test_get_title(self, parse):
+    @patch('lifestreams.plugins.lifestream_rss.plugin.Fetcher')
+    def test_update_with_validators(self, Fetcher):
+        handler = RSSHandler(url=self.url, etag='"old"', modified='Mon, 11 Jun 2012 10:43:57 GMT')
+        response = Fetcher.return_value.fetch.return_value
+        response.error = None
+        response.parse.return_value = feedparser.FeedParserDict(status=200, etag='"new"',
+                                                                modified='Tue, 12 Jun 2012 10:43:57 GMT',
+                                                                feed=feedparser.FeedParserDict(title='title'),
+                                                                entries=[])
+
+        handler.update()
+
+        Fetcher.return_value.fetch.assert_called_once_with(self.url, '"old"', 'Mon, 11 Jun 2012 10:43:57 GMT')
+        self.assertFalse(handler.not_modified)
+        self.assertEqual('"new"', handler.etag)
+        self.assertEqual('Tue, 12 Jun 2012 10:43:57 GMT', handler.modified)
+
+    @patch('lifestreams.plugins.lifestream_rss.plugin.Fetcher')
+    @patch('lifestreams.plugins.lifestream_rss.plugin.RSSHandler.get_title')
+    def test_update_not_modified(self, get_title, Fetcher):
+        handler = RSSHandler(url=self.url, etag='"etag"')
+        Fetcher.return_value.fetch.return_value = Response(self.url, status=304)
+
+        result = handler.update()
+
+        self.assertEqual([], result)
+        self.assertTrue(handler.not_modified)
+        self.assertFalse(get_title.called)
+
+    def test_get_title(self):
         handler = RSSHandler(url=self.url)
         handler.data = Mock()
 
@@ -161,12 +383,526 @@ class RSSHandlerTest(TestCase):
 
         self.assertEqual(handler.data.feed.title, result)
 
-    @patch('feedparser.parse')
+    @patch('lifestreams.plugins.lifestream_rss.plugin.Fetcher')
     @patch('lifestreams.plugins.lifestream_rss.plugin.RSSHandler.get_title')
-    def test_update_no_title(self, get_title, parse):
+    def test_update_no_title(self, get_title, Fetcher):
         handler = RSSHandler(url=self.url)
-        data = parse.return_value
-        data.entries = [Mock(), Mock()]
+        response = Fetcher.return_value.fetch.return_value
+        response.error = None
+        response.parse.return_value.entries = [Mock(), Mock()]
         get_title.side_effect = AttributeError
 
         self.assertRaises(FeedErrorException, handler.update)
+
+    @patch('lifestreams.plugins.lifestream_rss.plugin.Fetcher')
+    def test_update_fetch_error(self, Fetcher):
+        handler = RSSHandler(url=self.url)
+        Fetcher.return_value.fetch.return_value = Response(self.url, status=500, error=FetchError(500))
+
+        self.assertRaises(FeedErrorException, handler.update)
+
+
+RSS_DOCUMENT = '''<?xml version="1.0"?>
+<rss version="2.0">
+<channel>
+<title>%(path)s</title>
+<link>http://uniquisimo.com</link>
+<item>
+<title>first</title>
+<link>http://uniquisimo.com%(path)s/1</link>
+<description>first</description>
+<pubDate>Tue, 12 Jun 2012 10:43:57 -0400</pubDate>
+</item>
+<item>
+<title>second</title>
+<link>http://uniquisimo.com%(path)s/2</link>
+<description>second</description>
+<pubDate>Mon, 11 Jun 2012 10:43:57 -0400</pubDate>
+</item>
+</channel>
+</rss>
+'''
+
+ATOM_DOCUMENT = '''<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+<title>atom</title>
+<entry>
+<title>first</title>
+<link rel="alternate" href="http://uniquisimo.com/atom/1"/>
+<summary>first &lt;script&gt;alert(1)&lt;/script&gt;</summary>
+<updated>2012-06-12T10:43:57Z</updated>
+</entry>
+</feed>
+'''
+
+RSS_ITEM = '''<item>
+<title>%(position)d</title>
+<link>http://uniquisimo.com%(path)s/%(position)d</link>
+<description>%(position)d</description>
+<pubDate>%(published)s</pubDate>
+</item>
+'''
+
+
+def large_document(path, size):
+    yield '<?xml version="1.0"?>\n<rss version="2.0">\n<channel>\n<title>%s</title>\n' % path
+    for position in range(size):
+        published = 'Tue, 12 Jun 2012 %02d:%02d:00 -0400' % divmod(24 * 60 - 1 - position, 60)
+        yield RSS_ITEM % {'path': path, 'position': position, 'published': published}
+    yield '</channel>\n</rss>\n'
+
+
+class FeedServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, delay=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FeedRequestHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        self.connections = 0
+
+    def get_url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_port, path)
+
+
+class FeedRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.delay)
+            if self.path.startswith('/missing'):
+                self.send_error(404)
+            elif self.path.startswith('/redirect'):
+                self.send_response(301)
+                self.send_header('Location', self.path[len('/redirect'):])
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            elif self.headers.get('If-None-Match') == '"%s"' % self.path:
+                self.send_response(304)
+                self.end_headers()
+            elif self.path.startswith('/large/') or self.path.startswith('/stall/'):
+                # Without a length the end of the document is the end of the connection.
+                self.close_connection = 1
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/rss+xml')
+                self.send_header('ETag', '"%s"' % self.path)
+                self.end_headers()
+                size = int(self.path.rsplit('/', 1)[-1])
+                for position, chunk in enumerate(large_document(self.path, size)):
+                    if position == size // 2 and self.path.startswith('/stall/'):
+                        time.sleep(0.5)
+                    self.wfile.write(chunk)
+                    self.wfile.flush()
+            else:
+                body = RSS_DOCUMENT % {'path': self.path}
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/rss+xml')
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    buffer = StringIO()
+                    document = gzip.GzipFile(fileobj=buffer, mode='wb')
+                    document.write(body)
+                    document.close()
+                    body = buffer.getvalue()
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', '"%s"' % self.path)
+                self.end_headers()
+                self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def handle(self):
+        # Streaming clients may hang up before the whole document is sent.
+        try:
+            BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            self.close_connection = 1
+
+    def finish(self):
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class FeedServerTestCase(TestCase):
+    delay = 0
+
+    def setUp(self):
+        self.server = FeedServer(delay=self.delay)
+        thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.01})
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        connection_pool.close_idle()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FetcherTest(FeedServerTestCase):
+    delay = 0.05
+
+    def test_fetch(self):
+        fetcher = Fetcher()
+
+        response = fetcher.fetch(self.server.get_url('/feed'))
+
+        self.assertEqual(200, response.status)
+        self.assertIsNone(response.error)
+        data = response.parse()
+        self.assertEqual('/feed', data.feed.title)
+        self.assertEqual('"/feed"', data.etag)
+        self.assertEqual(2, len(data.entries))
+        self.assertFalse(data.bozo)
+        self.assertNotIn('content-encoding', response.headers)
+
+    def test_fetch_not_modified(self):
+        fetcher = Fetcher()
+
+        response = fetcher.fetch(self.server.get_url('/feed'), etag='"/feed"')
+
+        self.assertEqual(304, response.status)
+        self.assertEqual(304, response.parse().status)
+        self.assertEqual([], response.parse().entries)
+
+    def test_fetch_error(self):
+        fetcher = Fetcher()
+
+        response = fetcher.fetch(self.server.get_url('/missing'))
+
+        self.assertEqual(404, response.status)
+        self.assertIsNotNone(response.error)
+
+    def test_fetch_all(self):
+        fetcher = Fetcher(workers=8, pool=ConnectionPool(per_host=3))
+        urls = [self.server.get_url('/feed/%d' % i) for i in range(12)]
+
+        responses = fetcher.fetch_all([(url, None, None) for url in urls])
+
+        self.assertEqual(urls, [response.url for response in responses])
+        for i, response in enumerate(responses):
+            self.assertEqual('/feed/%d' % i, response.parse().feed.title)
+        self.assertEqual(12, self.server.requests)
+        self.assertTrue(1 < self.server.max_in_flight <= 3)
+
+    def test_fetch_all_per_host(self):
+        fetcher = Fetcher(workers=8, pool=ConnectionPool(per_host=1))
+        urls = [self.server.get_url('/feed/%d' % i) for i in range(4)]
+        urls += [url.replace('127.0.0.1', 'localhost') for url in urls]
+
+        fetcher.fetch_all([(url, None, None) for url in urls])
+
+        self.assertEqual(2, self.server.max_in_flight)
+
+
+class ConnectionPoolTest(FeedServerTestCase):
+    def setUp(self):
+        super(ConnectionPoolTest, self).setUp()
+        self.pool = ConnectionPool(per_host=2)
+        self.addCleanup(self.pool.close_idle)
+
+    def test_keep_alive(self):
+        fetcher = Fetcher(pool=self.pool)
+
+        for path in ('/feed/1', '/feed/2', '/missing', '/feed/3'):
+            fetcher.fetch(self.server.get_url(path))
+        fetcher.fetch(self.server.get_url('/feed/1'), etag='"/feed/1"')
+
+        self.assertEqual(5, self.server.requests)
+        self.assertEqual(2, self.server.connections)
+        self.assertEqual({'requests': 5, 'connections': 2, 'reused': 3}, self.get_counts())
+
+    def test_keep_alive_threads(self):
+        fetcher = Fetcher(workers=8, pool=self.pool)
+        urls = [self.server.get_url('/feed/%d' % i) for i in range(12)]
+
+        fetcher.fetch_all([(url, None, None) for url in urls])
+
+        self.assertEqual(12, self.server.requests)
+        self.assertTrue(self.server.connections <= 2)
+
+    def test_gzip(self):
+        with patch('lifestreams.plugins.lifestream_rss.fetcher.decode_body', wraps=decode_body) as decode:
+            response = Fetcher(pool=self.pool).fetch(self.server.get_url('/feed'))
+
+        self.assertEqual('gzip', decode.call_args[0][1])
+        self.assertNotIn('content-encoding', response.headers)
+        data = response.parse()
+        self.assertFalse(data.bozo)
+        self.assertEqual('/feed', data.feed.title)
+
+    def test_redirect(self):
+        response = Fetcher(pool=self.pool).fetch(self.server.get_url('/redirect/feed'))
+
+        self.assertEqual(200, response.status)
+        self.assertEqual('/feed', response.parse().feed.title)
+        self.assertEqual(1, self.server.connections)
+
+    def test_idle_connection_dropped(self):
+        fetcher = Fetcher(pool=self.pool)
+        fetcher.fetch(self.server.get_url('/feed/1'))
+        for connections in self.pool.idle.values():
+            connections[0].sock.shutdown(socket.SHUT_RDWR)
+
+        response = fetcher.fetch(self.server.get_url('/feed/2'))
+
+        self.assertEqual('/feed/2', response.parse().feed.title)
+        self.assertEqual({'requests': 3, 'connections': 2, 'reused': 1}, self.get_counts())
+
+    def test_unread_response_not_reused(self):
+        response = self.pool.open(self.server.get_url('/large/500'))
+        response.read(100)
+        response.close()
+
+        Fetcher(pool=self.pool).fetch(self.server.get_url('/feed'))
+
+        self.assertEqual(2, self.server.connections)
+
+    def test_report(self):
+        Fetcher(pool=self.pool).fetch(self.server.get_url('/feed'))
+
+        with patch('lifestreams.plugins.lifestream_rss.fetcher.logger') as logger:
+            stats = self.pool.report()
+
+        self.assertEqual(1, stats['requests'])
+        self.assertTrue(stats['seconds'] > 0)
+        self.assertTrue(logger.info.called)
+        self.pool.reset_stats()
+        self.assertEqual({'requests': 0, 'connections': 0, 'reused': 0}, self.get_counts())
+
+    def get_counts(self):
+        stats = dict(self.pool.stats)
+        del stats['seconds']
+        return stats
+
+
+class ParseResponseTest(TestCase):
+    def test_parse_response(self):
+        response = Response('http://uniquisimo.com/feed', status=200, body=RSS_DOCUMENT % {'path': '/feed'},
+                            headers={'etag': '"etag"'})
+
+        data = parse_response(response)
+
+        self.assertEqual(200, data.status)
+        self.assertEqual('"etag"', data.etag)
+        self.assertEqual('/feed', data.feed.title)
+        self.assertEqual(Entry('http://uniquisimo.com/feed/1', 'first', 'Tue, 12 Jun 2012 10:43:57 -0400'),
+                         data.entries[0])
+        self.assertEqual(2, len(data.entries))
+
+    def test_parse_response_without_title(self):
+        response = Response('http://uniquisimo.com/feed', status=200, body='<rss><channel></channel></rss>')
+        handler = RSSHandler(url=response.url, response=response)
+        response.data = parse_response(response)
+
+        self.assertRaises(FeedErrorException, handler.update)
+
+    def test_parse_responses(self):
+        responses = [Response('http://uniquisimo.com/feed/%d' % i, status=200,
+                              body=RSS_DOCUMENT % {'path': '/feed/%d' % i}) for i in range(4)]
+        responses.append(Response('http://uniquisimo.com/missing', status=404, error=Exception()))
+
+        parse_responses(responses, processes=2)
+
+        for i, response in enumerate(responses[:4]):
+            self.assertIsNone(response.body)
+            self.assertEqual('/feed/%d' % i, response.parse().feed.title)
+        self.assertIsNone(responses[4].data)
+
+
+class PrefetchTest(FeedServerTestCase):
+    def setUp(self):
+        super(PrefetchTest, self).setUp()
+        feed_plugin = 'lifestreams.plugins.lifestream_rss.plugin.RSSPlugin'
+        lifestream = Lifestream.objects.create(name='lifestream')
+        self.feeds = []
+        for path in ('/feed/1', '/feed/2', '/missing'):
+            feed = Feed.objects.create(title=path, feed_plugin=feed_plugin, lifestream=lifestream)
+            RSSFeed.objects.create(feed=feed, url=self.server.get_url(path))
+            self.feeds.append(feed)
+        self.feeds.append(Feed.objects.create(title='unconfigured', feed_plugin=feed_plugin, lifestream=lifestream))
+
+    def test_prefetch(self):
+        plugins = [RSSPlugin(feed=feed) for feed in self.feeds]
+
+        RSSPlugin.prefetch(plugins, workers=4)
+
+        self.assertEqual(3, self.server.requests)
+        self.assertEqual([200, 200, 404], [plugin.response.status for plugin in plugins[:3]])
+        self.assertIsNone(plugins[3].response)
+        plugins[0].update()
+        self.assertEqual(2, self.feeds[0].items.count())
+        self.assertEqual('"/feed/1"', RSSFeed.objects.get(feed=self.feeds[0]).etag)
+        self.assertRaises(FeedErrorException, plugins[2].update)
+        self.assertEqual(3, self.server.requests)
+
+    def test_prefetch_processes(self):
+        plugins = [RSSPlugin(feed=feed) for feed in self.feeds]
+
+        RSSPlugin.prefetch(plugins, workers=4, processes=2)
+
+        self.assertIsInstance(plugins[0].response.data.entries[0], Entry)
+        plugins[0].update()
+        plugins[1].update()
+        self.assertEqual(4, Item.objects.count())
+
+    def test_update_lifestreams_async(self):
+        call_command('update_lifestreams', async_fetch=True, workers=4)
+        call_command('update_lifestreams', async_fetch=True, workers=4)
+
+        self.assertEqual(6, self.server.requests)
+        self.assertEqual({}, connection_pool.idle)
+        self.assertEqual(4, Item.objects.count())
+        self.assertEqual(2, self.feeds[1].items.count())
+
+
+
+class StreamParserTest(TestCase):
+    def test_parse_rss(self):
+        parser = StreamParser(StringIO(RSS_DOCUMENT % {'path': '/feed'}))
+
+        entries = list(parser)
+
+        self.assertEqual('/feed', parser.title)
+        self.assertEqual([Entry('http://uniquisimo.com/feed/1', 'first', 'Tue, 12 Jun 2012 10:43:57 -0400'),
+                          Entry('http://uniquisimo.com/feed/2', 'second', 'Mon, 11 Jun 2012 10:43:57 -0400')],
+                         entries)
+
+    def test_parse_atom(self):
+        parser = StreamParser(StringIO(ATOM_DOCUMENT))
+
+        entries = list(parser)
+
+        self.assertEqual('atom', parser.title)
+        self.assertEqual('http://uniquisimo.com/atom/1', entries[0].link)
+        self.assertEqual('2012-06-12T10:43:57Z', entries[0].published)
+        self.assertNotIn('script', entries[0].summary)
+
+    def test_parse_is_lazy(self):
+        stream = StringIO(''.join(large_document('/large/2000', 2000)))
+        parser = iter(StreamParser(stream))
+
+        entry = next(parser)
+
+        self.assertEqual('http://uniquisimo.com/large/2000/0', entry.link)
+        self.assertTrue(stream.tell() < stream.len)
+
+
+class IncrementalTest(FeedServerTestCase):
+    def setUp(self):
+        super(IncrementalTest, self).setUp()
+        feed_plugin = 'lifestreams.plugins.lifestream_rss.plugin.RSSPlugin'
+        lifestream = Lifestream.objects.create(name='lifestream')
+        self.feed = Feed.objects.create(title='large', feed_plugin=feed_plugin, lifestream=lifestream)
+        self.rss_feed = RSSFeed.objects.create(feed=self.feed, url=self.server.get_url('/large/250'),
+                                               incremental=True)
+
+    def test_update_returns_generator(self):
+        handler = RSSHandler(url=self.rss_feed.url, incremental=True)
+
+        entries = handler.update()
+
+        self.assertFalse(isinstance(entries, list))
+        self.assertEqual('"/large/250"', handler.etag)
+        self.assertEqual('http://uniquisimo.com/large/250/0', next(entries).link)
+        self.assertEqual('/large/250', handler.title)
+
+    def test_update_stalled(self):
+        handler = RSSHandler(url=self.server.get_url('/stall/250'), incremental=True)
+
+        with patch.object(connection_pool, 'timeout', 0.1):
+            entries = handler.update()
+
+            self.assertRaises(FeedErrorException, list, entries)
+
+    def test_update_max_entries(self):
+        handler = RSSHandler(url=self.rss_feed.url, incremental=True, max_entries=10)
+
+        self.assertEqual(10, len(list(handler.update())))
+
+    def test_update_not_modified(self):
+        handler = RSSHandler(url=self.rss_feed.url, etag='"/large/250"', incremental=True)
+
+        self.assertEqual([], handler.update())
+        self.assertTrue(handler.not_modified)
+
+    def test_update_error(self):
+        handler = RSSHandler(url=self.server.get_url('/missing'), incremental=True)
+
+        self.assertRaises(FeedErrorException, handler.update)
+
+    @patch('lifestreams.plugins.lifestream_rss.plugin.StreamParser')
+    def test_update_invalid_document(self, StreamParser):
+        StreamParser.return_value = iter(Mock(side_effect=SyntaxError), None)
+        handler = RSSHandler(url=self.rss_feed.url, incremental=True)
+
+        self.assertRaises(FeedErrorException, list, handler.update())
+
+    @override_settings(LIFESTREAMS_RSS_MAX_ENTRIES=120)
+    def test_plugin_update(self):
+        self.feed.update()
+        self.feed.update()
+
+        self.assertEqual(120, self.feed.items.count())
+        self.assertEqual('http://uniquisimo.com/large/250/0', Feed.objects.get(pk=self.feed.pk).last_id)
+        self.assertEqual('"/large/250"', RSSFeed.objects.get(pk=self.rss_feed.pk).etag)
+
+    def test_plugin_stops_at_ingested_entry(self):
+        self.feed.update()
+        self.rss_feed.etag = ''
+        self.rss_feed.save()
+        plugin = RSSPlugin(feed=Feed.objects.get(pk=self.feed.pk))
+        entries = plugin.fetch()
+        consumed = []
+
+        def counted():
+            for entry in entries:
+                consumed.append(entry)
+                yield entry
+
+        plugin.save(counted())
+
+        # The last ingested entry is checked for duplicates, the next one is older.
+        self.assertEqual(2, len(consumed))
+        self.assertEqual(250, self.feed.items.count())
+
+    @patch('lifestreams.plugins.lifestream_rss.fetcher.logger')
+    def test_update_lifestreams_reports_connections(self, logger):
+        self.rss_feed.incremental = False
+        self.rss_feed.url = self.server.get_url('/feed/1')
+        self.rss_feed.save()
+        feed = Feed.objects.create(title='small', feed_plugin=self.feed.feed_plugin, lifestream=self.feed.lifestream)
+        RSSFeed.objects.create(feed=feed, url=self.server.get_url('/feed/2'))
+
+        call_command('update_lifestreams')
+
+        stats = logger.info.call_args[0][1]
+        self.assertEqual((2, 1, 1), (stats['requests'], stats['connections'], stats['reused']))
+        self.assertEqual(1, self.server.connections)
+
+    def test_prefetch_skips_incremental(self):
+        plugin = RSSPlugin(feed=self.feed)
+
+        RSSPlugin.prefetch([plugin])
+
+        self.assertIsNone(plugin.response)
+        self.assertEqual(0, self.server.requests)
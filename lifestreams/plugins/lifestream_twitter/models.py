@@ -7,6 +7,8 @@ class TwitterFeed(models.Model):
     screen_name = models.CharField(max_length=100)
     access_token = models.CharField(max_length=100)
     access_token_secret = models.CharField(max_length=100)
+    backfill_since_id = models.CharField(max_length=100, blank=True)
+    backfill_max_id = models.CharField(max_length=100, blank=True)
 
     def __unicode__(self):
         return unicode(self.feed)
@@ -1,4 +1,5 @@
 import logging
+from hashlib import sha1
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
@@ -6,9 +7,12 @@ from django.core.exceptions import ImproperlyConfigured
 import pytz
 import tweepy
 
+from lifestreams.models import Item
+from lifestreams.clients import client_cache
 from lifestreams.plugins import BasePlugin
+from lifestreams.ratelimit import rate_limiter
 from lifestreams.utils import get_setting
-from lifestreams.exceptions import FeedNotConfiguredException, FeedErrorException
+from lifestreams.exceptions import FeedNotConfiguredException, FeedErrorException, FeedDeferredException
 
 from .models import ItemTweet, TwitterFeed
 
@@ -28,32 +32,87 @@ class TweetsHandler(object):
     def __init__(self, access_token, access_token_secret, screen_name):
         consumer_key = get_setting('TWITTER_CONSUMER_KEY')
         consumer_secret = get_setting('TWITTER_CONSUMER_SECRET')
-        auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
-        auth.set_access_token(access_token, access_token_secret)
-        self.api = tweepy.API(auth)
+        key = ('twitter', consumer_key, consumer_secret, access_token, access_token_secret)
+        self.api = client_cache.get_or_create(key, lambda: self.get_api(consumer_key, consumer_secret,
+                                                                        access_token, access_token_secret))
         self.screen_name = screen_name
+        # Twitter counts calls per application and user token.
+        credentials = sha1('%s:%s' % (consumer_key, access_token)).hexdigest()
+        self.rate_limit_key = 'twitter:%s:statuses/user_timeline' % credentials
 
-    def update(self, *args, **kwargs):
+    def get_api(self, consumer_key, consumer_secret, access_token, access_token_secret):
+        auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
+        auth.set_access_token(access_token, access_token_secret)
+        return tweepy.API(auth)
+
+    def update(self, since_id=None, max_id=None, count=200):
+        '''
+        Pages back from max_id, or the latest tweet, until since_id is reached.
+        Tweets are yielded newest first as each page arrives.
+        '''
+        kwargs = {'screen_name': self.screen_name, 'count': count}
+        if since_id:
+            kwargs['since_id'] = since_id
+        while True:
+            if max_id is not None:
+                kwargs['max_id'] = max_id
+            page = self.user_timeline(**kwargs)
+            if not page:
+                return
+            for tweet in page:
+                yield tweet
+            max_id = min(tweet.id for tweet in page) - 1
+
+    def user_timeline(self, **kwargs):
+        capacity, window = get_setting('LIFESTREAMS_TWITTER_RATE_LIMIT')
+        rate_limiter.consume(self.rate_limit_key, capacity, window)
         try:
-            kwargs.update({'screen_name': self.screen_name})
-            return self.api.user_timeline(*args, **kwargs)
+            return self.api.user_timeline(**kwargs)
         except tweepy.TweepError, e:
+            if e.response is not None and e.response.status == 429:
+                logger.warn('Twitter rate limit exceeded for %s.', self.screen_name)
+                raise FeedDeferredException(rate_limiter.exhaust(self.rate_limit_key, capacity, window))
             logger.warn('TweepError, %s', e.reason)
             raise FeedErrorException()
 
 
 class TwitterPlugin(BasePlugin):
-
-    def create_item(self, tweet):
+    related_model = ItemTweet
+    twitter_feed = None
+
+    def save(self, tweets):
+        super(TwitterPlugin, self).save(tweets)
+        if self.twitter_feed is not None:
+            self.save_checkpoint('')
+        return self
+
+    def save_batch(self, tweets):
+        items = super(TwitterPlugin, self).save_batch(tweets)
+        if self.twitter_feed is not None and tweets:
+            # Everything newer than the oldest saved tweet is stored, an
+            # interrupted update resumes below it.
+            self.save_checkpoint(unicode(min(tweet.id for tweet in tweets) - 1))
+        return items
+
+    def save_checkpoint(self, max_id):
+        since_id = max_id and self.since_id or ''
+        twitter_feed = self.twitter_feed
+        if (since_id, max_id) != (twitter_feed.backfill_since_id, twitter_feed.backfill_max_id):
+            twitter_feed.backfill_since_id, twitter_feed.backfill_max_id = since_id, max_id
+            TwitterFeed.objects.filter(pk=twitter_feed.pk).update(backfill_since_id=since_id,
+                                                                  backfill_max_id=max_id)
+
+    def build_item(self, tweet):
         link = 'https://twitter.com/%s/status/%s' % (
             tweet.author.screen_name, tweet.id)
-        item = self.feed.items.create(content=tweet.text,
-                                      author=tweet.author.screen_name,
-                                      published=pytz.UTC.localize(
-                                          tweet.created_at),
-                                      link=link)
-        itemtweet = ItemTweet(item=item, tweet_id=tweet.id)
-        itemtweet.save()
+        return Item(feed=self.feed,
+                    content=tweet.text,
+                    author=tweet.author.screen_name,
+                    published=pytz.UTC.localize(tweet.created_at),
+                    link=link)
+
+    def build_related(self, tweet, item):
+        return ItemTweet(item=item, tweet_id=tweet.id)
 
     def get_handler(self):
         return TweetsHandler(**self.get_handler_kwargs())
@@ -71,12 +130,22 @@ class TwitterPlugin(BasePlugin):
 
     def get_update_kwargs(self):
         kwargs = {}
-        last_id = self.get_last_id()
-        if last_id:
-            kwargs['since_id'] = last_id
+        self.twitter_feed = self.feed.twitter
+        if self.twitter_feed.backfill_max_id:
+            self.since_id = self.twitter_feed.backfill_since_id
+            kwargs['max_id'] = self.twitter_feed.backfill_max_id
+        else:
+            self.since_id = self.get_last_id()
+        if self.since_id:
+            kwargs['since_id'] = self.since_id
         return kwargs
 
+    def get_entry_id(self, tweet):
+        return tweet.id
+
     def get_last_id(self):
+        if self.feed.last_id:
+            return self.feed.last_id
         try:
             last_item = self.feed.items.latest('published')
             return last_item.tweet.tweet_id
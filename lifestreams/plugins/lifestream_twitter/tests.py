@@ -1,20 +1,50 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from itertools import imap
 
+from django.core.management import call_command
 from django.test import TestCase
 from django.test.utils import override_settings
-from django.utils.timezone import is_aware
+from django.template import Template
+from django.utils.timezone import is_aware, now
 
 import pytz
 from mock import patch, Mock
 from tweepy import TweepError
 
-from lifestreams.models import Feed, Lifestream
-from lifestreams.exceptions import FeedNotConfiguredException, FeedErrorException
+from lifestreams.models import Feed, Lifestream, Item, render_items
+from lifestreams.clients import client_cache
+from lifestreams.ratelimit import rate_limiter
+from lifestreams.exceptions import FeedNotConfiguredException, FeedErrorException, FeedDeferredException
 
 from .plugin import TwitterPlugin, TweetsHandler
-from .models import TwitterFeed
+from .models import TwitterFeed, ItemTweet
 
 
+class StubAPI(object):
+    '''
+    Stands in for tweepy.API, serving a timeline of tweet ids with
+    user_timeline's paging rules. The call number fail_on raises TweepError.
+    '''
+
+    def __init__(self, ids, fail_on=None, status=500):
+        self.ids = sorted(ids, reverse=True)
+        self.fail_on = fail_on
+        self.status = status
+        self.calls = []
+
+    def user_timeline(self, screen_name, count=20, since_id=None, max_id=None):
+        self.calls.append({'since_id': since_id, 'max_id': max_id})
+        if len(self.calls) == self.fail_on:
+            raise TweepError('Failed', Mock(status=self.status))
+        ids = [tweet_id for tweet_id in self.ids
+               if (since_id is None or tweet_id > int(since_id)) and (max_id is None or tweet_id <= int(max_id))]
+        return [self.get_tweet(screen_name, tweet_id) for tweet_id in ids[:count]]
+
+    def get_tweet(self, screen_name, tweet_id):
+        tweet = Mock(id=tweet_id, text='tweet %d' % tweet_id, created_at=datetime(2013, 1, 1) + timedelta(minutes=tweet_id))
+        tweet.author.screen_name = screen_name
+        return tweet
+
 
 class PluginTest(TestCase):
     def setUp(self):
@@ -29,6 +59,10 @@ class PluginTest(TestCase):
                                         access_token=self.access_token,
                                         access_token_secret=self.access_token_secret)
         self.twitter_feed.save()
+        rate_limiter.clear()
+        self.addCleanup(rate_limiter.clear)
+        client_cache.clear()
+        self.addCleanup(client_cache.clear)
     
     @patch('lifestreams.plugins.lifestream_twitter.plugin.TweetsHandler')
     def test_handler_called(self, TweetsHandler):
@@ -91,6 +125,7 @@ class PluginTest(TestCase):
     @patch('lifestreams.plugins.lifestream_twitter.plugin.TweetsHandler')
     def test_update_item_created(self, TweetsHandler):
         tweet = Mock()
+        tweet.id = 1
         tweet.created_at = datetime.now()
         tweets = [tweet]
         handler = TweetsHandler.return_value
@@ -106,8 +141,10 @@ class PluginTest(TestCase):
     @patch('lifestreams.plugins.lifestream_twitter.plugin.TweetsHandler')
     def test_update_items_created(self, TweetsHandler):
         tweet1 = Mock()
+        tweet1.id = 1
         tweet1.created_at = datetime.now()
         tweet2 = Mock()
+        tweet2.id = 2
         tweet2.created_at = datetime.now()
         tweets = [tweet1, tweet2]
         handler = TweetsHandler.return_value
@@ -125,17 +162,139 @@ class PluginTest(TestCase):
     @patch('lifestreams.plugins.lifestream_twitter.plugin.TweetsHandler')
     def test_update_items_created_with_already_created(self, TweetsHandler):
         tweet1 = Mock()
+        tweet1.id = 1
         tweet1.created_at = datetime.now()
         handler = TweetsHandler.return_value
         plugin = TwitterPlugin(feed=self.feed)
         plugin.create_item(tweet1)
         tweet2 = Mock()
+        tweet2.id = 2
         tweet2.created_at = datetime.now()
         handler.update.return_value = [tweet2]
 
         plugin.update()
         handler.update.assert_called_with(since_id=unicode(tweet1.id))
 
+    @patch('lifestreams.plugins.lifestream_twitter.plugin.TweetsHandler')
+    def test_update_items_created_in_bulk(self, TweetsHandler):
+        tweets = []
+        for i in range(200):
+            tweet = Mock()
+            tweet.id = i
+            tweet.created_at = datetime.now()
+            tweets.append(tweet)
+        handler = TweetsHandler.return_value
+        handler.update.return_value = tweets
+        plugin = TwitterPlugin(feed=self.feed)
+
+        with self.assertNumQueries(14):
+            plugin.update()
+
+        self.assertEqual(200, self.feed.items.count())
+        for item in self.feed.items.all():
+            self.assertEqual(item.link.rsplit('/', 1)[1], item.tweet.tweet_id)
+        self.assertEqual('199', Feed.objects.get(pk=self.feed.pk).last_id)
+
+    def test_get_update_kwargs_from_feed(self):
+        self.feed.last_id = '1234'
+        self.feed.twitter
+        plugin = TwitterPlugin(feed=self.feed)
+
+        with self.assertNumQueries(0):
+            kwargs = plugin.get_update_kwargs()
+
+        self.assertEqual({'since_id': '1234'}, kwargs)
+
+    def test_get_update_kwargs_resume(self):
+        self.feed.last_id = '1234'
+        self.twitter_feed.backfill_since_id = '1000'
+        self.twitter_feed.backfill_max_id = '1099'
+        self.twitter_feed.save()
+        plugin = TwitterPlugin(feed=self.feed)
+
+        kwargs = plugin.get_update_kwargs()
+
+        self.assertEqual({'since_id': '1000', 'max_id': '1099'}, kwargs)
+
+    @patch('tweepy.API')
+    def test_update_backfill_resumes(self, API):
+        API.return_value = StubAPI(range(1, 451), fail_on=3)
+        plugin = TwitterPlugin(feed=self.feed)
+
+        self.assertRaises(FeedErrorException, plugin.update)
+
+        self.assertEqual(400, self.feed.items.count())
+        twitter_feed = TwitterFeed.objects.get(pk=self.twitter_feed.pk)
+        self.assertEqual(('', '50'), (twitter_feed.backfill_since_id, twitter_feed.backfill_max_id))
+        self.assertEqual('450', Feed.objects.get(pk=self.feed.pk).last_id)
+
+        API.return_value = StubAPI(range(1, 461))
+        client_cache.clear()
+        TwitterPlugin(feed=Feed.objects.get(pk=self.feed.pk)).update()
+
+        self.assertEqual([{'since_id': None, 'max_id': '50'}, {'since_id': None, 'max_id': 0}],
+                         API.return_value.calls)
+        self.assertEqual(450, self.feed.items.count())
+        twitter_feed = TwitterFeed.objects.get(pk=self.twitter_feed.pk)
+        self.assertEqual(('', ''), (twitter_feed.backfill_since_id, twitter_feed.backfill_max_id))
+
+        TwitterPlugin(feed=Feed.objects.get(pk=self.feed.pk)).update()
+
+        self.assertEqual(460, self.feed.items.count())
+        self.assertEqual('460', Feed.objects.get(pk=self.feed.pk).last_id)
+
+    @patch('lifestreams.management.commands.update_lifestreams.ThreadPool')
+    @patch('tweepy.API')
+    def test_update_backfill_resumes_with_workers(self, API, ThreadPool):
+        # The in-memory test database can't be shared with other threads.
+        ThreadPool.return_value.imap_unordered = imap
+        API.return_value = StubAPI(range(1, 451), fail_on=3)
+
+        call_command('update_lifestreams', workers=2)
+
+        self.assertEqual(400, self.feed.items.count())
+        twitter_feed = TwitterFeed.objects.get(pk=self.twitter_feed.pk)
+        self.assertEqual(('', '50'), (twitter_feed.backfill_since_id, twitter_feed.backfill_max_id))
+
+        API.return_value = StubAPI(range(1, 461))
+        client_cache.clear()
+        call_command('update_lifestreams', workers=2)
+
+        self.assertEqual(450, self.feed.items.count())
+        twitter_feed = TwitterFeed.objects.get(pk=self.twitter_feed.pk)
+        self.assertEqual(('', ''), (twitter_feed.backfill_since_id, twitter_feed.backfill_max_id))
+
+    @patch('tweepy.API')
+    def test_update_backfill_since_last_id(self, API):
+        API.return_value = StubAPI(range(1, 51))
+        TwitterPlugin(feed=self.feed).update()
+        API.return_value = StubAPI(range(1, 351), fail_on=2)
+        client_cache.clear()
+
+        self.assertRaises(FeedErrorException, TwitterPlugin(feed=Feed.objects.get(pk=self.feed.pk)).update)
+
+        twitter_feed = TwitterFeed.objects.get(pk=self.twitter_feed.pk)
+        self.assertEqual(('50', '150'), (twitter_feed.backfill_since_id, twitter_feed.backfill_max_id))
+        API.return_value = StubAPI(range(1, 351))
+        client_cache.clear()
+        TwitterPlugin(feed=Feed.objects.get(pk=self.feed.pk)).update()
+
+        self.assertEqual(350, self.feed.items.count())
+        self.assertEqual(350, ItemTweet.objects.values('tweet_id').distinct().count())
+
+    @patch('lifestreams.models.get_template')
+    def test_render_items(self, get_template):
+        get_template.return_value = Template('{{ item.tweet.tweet_id }};')
+        for i in range(3):
+            item = self.feed.items.create(published=now(), link='https://twitter.com/uniquisimo/status/%d' % i)
+            ItemTweet.objects.create(item=item, tweet_id=i)
+
+        with self.assertNumQueries(3):
+            result = render_items(Item.objects.all())
+
+        self.assertEqual(set(['0', '1', '2']), set(result.split(';')[:-1]))
+        get_template.assert_called_once_with('lifestreams/twitter/item.html')
+
     def assert_compare_tweet_item(self, tweet, item):
         self.assertEqual(unicode(tweet.text), item.content)
         self.assertEqual(unicode(tweet.author.screen_name), item.author)
@@ -164,6 +323,10 @@ class TweetsHandlerTest(TestCase):
         self.access_token = 'c'
         self.access_token_secret = 'd'
         self.screen_name = 'pedro_witoi'
+        rate_limiter.clear()
+        self.addCleanup(rate_limiter.clear)
+        client_cache.clear()
+        self.addCleanup(client_cache.clear)
 
     @patch('tweepy.OAuthHandler')
     @patch('tweepy.API')
@@ -191,35 +354,108 @@ class TweetsHandlerTest(TestCase):
         auth.set_access_token.assert_called_once_with(self.access_token, self.access_token_secret)
         API.assert_called_once_with(auth)
 
+    @patch('tweepy.OAuthHandler')
+    @patch('tweepy.API')
+    def test_api_shared_by_credentials(self, API, OAuthHandler):
+        handler = TweetsHandler(access_token=self.access_token, access_token_secret=self.access_token_secret,
+                                screen_name=self.screen_name)
+        other = TweetsHandler(access_token=self.access_token, access_token_secret=self.access_token_secret,
+                              screen_name='uniquisimo')
+        API.return_value = Mock()
+        another = TweetsHandler(access_token='e', access_token_secret='f', screen_name=self.screen_name)
+
+        self.assertIs(handler.api, other.api)
+        self.assertIsNot(handler.api, another.api)
+        self.assertEqual(2, API.call_count)
+        self.assertEqual(2, OAuthHandler.call_count)
+
     @patch('tweepy.API')
     def test_update(self, API):
+        api = API.return_value = StubAPI(range(1, 451))
         handler = TweetsHandler(access_token=self.access_token, access_token_secret=self.access_token_secret,
                                 screen_name=self.screen_name)
-        api = API.return_value
 
-        result = handler.update()
+        result = [tweet.id for tweet in handler.update()]
 
-        api.user_timeline.assert_called_once_with(screen_name=self.screen_name)
-        self.assertEqual(api.user_timeline.return_value, result)
+        self.assertEqual(range(450, 0, -1), result)
+        self.assertEqual([{'since_id': None, 'max_id': None}, {'since_id': None, 'max_id': 250},
+                          {'since_id': None, 'max_id': 50}, {'since_id': None, 'max_id': 0}], api.calls)
 
     @patch('tweepy.API')
     def test_update_since_id(self, API):
+        api = API.return_value = StubAPI(range(1, 301))
         handler = TweetsHandler(access_token=self.access_token, access_token_secret=self.access_token_secret,
                                 screen_name=self.screen_name)
-        api = API.return_value
 
-        result = handler.update(since_id=1)
+        result = [tweet.id for tweet in handler.update(since_id='100')]
+
+        self.assertEqual(range(300, 100, -1), result)
+        self.assertEqual([{'since_id': '100', 'max_id': None}, {'since_id': '100', 'max_id': 100}], api.calls)
+
+    @patch('tweepy.API')
+    def test_update_max_id(self, API):
+        api = API.return_value = StubAPI(range(1, 301))
+        handler = TweetsHandler(access_token=self.access_token, access_token_secret=self.access_token_secret,
+                                screen_name=self.screen_name)
+
+        result = [tweet.id for tweet in handler.update(since_id='100', max_id='150')]
+
+        self.assertEqual(range(150, 100, -1), result)
+        self.assertEqual([{'since_id': '100', 'max_id': '150'}, {'since_id': '100', 'max_id': 100}], api.calls)
+
+    @patch('tweepy.API')
+    def test_update_pages_lazily(self, API):
+        api = API.return_value = StubAPI(range(1, 451))
+        handler = TweetsHandler(access_token=self.access_token, access_token_secret=self.access_token_secret,
+                                screen_name=self.screen_name)
 
-        api.user_timeline.assert_called_once_with(screen_name=self.screen_name, since_id=1)
-        self.assertEqual(api.user_timeline.return_value, result)
+        self.assertEqual(450, next(handler.update()).id)
+        self.assertEqual(1, len(api.calls))
 
     @patch('tweepy.API')
     def test_update_error(self, API):
+        api = API.return_value = StubAPI(range(1, 451), fail_on=1)
+        handler = TweetsHandler(access_token=self.access_token, access_token_secret=self.access_token_secret,
+                                screen_name=self.screen_name)
+
+        self.assertRaises(FeedErrorException, list, handler.update())
+        self.assertEqual(1, len(api.calls))
+
+    @patch('tweepy.API')
+    @override_settings(LIFESTREAMS_TWITTER_RATE_LIMIT=(2, 60))
+    def test_update_deferred_without_budget(self, API):
+        api = API.return_value = StubAPI(range(1, 451))
         handler = TweetsHandler(access_token=self.access_token, access_token_secret=self.access_token_secret,
                                 screen_name=self.screen_name)
-        api = API.return_value
-        api.user_timeline.side_effect = TweepError('reason')
 
-        self.assertRaises(FeedErrorException, handler.update)
+        with self.assertRaises(FeedDeferredException) as context:
+            list(handler.update())
+
+        self.assertEqual(30, context.exception.retry_after)
+        self.assertEqual(2, len(api.calls))
+
+    @patch('tweepy.API')
+    @override_settings(LIFESTREAMS_TWITTER_RATE_LIMIT=(2, 60))
+    def test_update_budget_shared_by_credentials(self, API):
+        API.return_value = StubAPI(range(1, 11))
+        handler = TweetsHandler(access_token=self.access_token, access_token_secret=self.access_token_secret,
+                                screen_name=self.screen_name)
+        other = TweetsHandler(access_token=self.access_token, access_token_secret=self.access_token_secret,
+                              screen_name='uniquisimo')
+        another = TweetsHandler(access_token='e', access_token_secret='f', screen_name='uniquisimo')
+
+        list(handler.update())
+
+        self.assertRaises(FeedDeferredException, list, other.update())
+        self.assertEqual(10, len(list(another.update())))
+        self.assertEqual([0, 0], sorted(rate_limiter.remaining().values()))
+
+    @patch('tweepy.API')
+    def test_update_rate_limited(self, API):
+        api = API.return_value = StubAPI(range(1, 451), fail_on=1, status=429)
+        handler = TweetsHandler(access_token=self.access_token, access_token_secret=self.access_token_secret,
+                                screen_name=self.screen_name)
 
-        api.user_timeline.assert_called_once_with(screen_name=self.screen_name)
+        self.assertRaises(FeedDeferredException, list, handler.update())
+        self.assertRaises(FeedDeferredException, list, handler.update())
+        self.assertEqual(1, len(api.calls))
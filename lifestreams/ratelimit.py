@@ -0,0 +1,123 @@
+import math
+import threading
+
+from django.db import transaction
+from django.utils.timezone import now
+
+from .exceptions import FeedDeferredException
+
+
+class TokenBucket(object):
+    '''
+    Allows `capacity` calls per `window` seconds, refilling continuously.
+    '''
+
+    def __init__(self, key, capacity, window, tokens=None, refreshed=None):
+        self.key = key
+        self.capacity = capacity
+        self.window = window
+        self.tokens = capacity if tokens is None else min(tokens, capacity)
+        self.refreshed = refreshed or now()
+
+    def refill(self):
+        current = now()
+        delta = current - self.refreshed
+        elapsed = delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0
+        self.tokens = min(self.capacity, self.tokens + max(elapsed, 0) * self.capacity / self.window)
+        self.refreshed = current
+
+    def consume(self):
+        self.refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def get_wait(self):
+        '''
+        Seconds until the next call is allowed.
+        '''
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+        return int(math.ceil((1 - self.tokens) * self.window / self.capacity))
+
+    def exhaust(self):
+        self.refill()
+        self.tokens = 0
+
+
+class RateLimiter(object):
+    '''
+    Token buckets by key, shared by every thread of the process. Buckets are
+    only read from and written to the database by load and save, so workers
+    never query it.
+    '''
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get_bucket(self, key, capacity, window):
+        bucket = self.buckets.get(key)
+        if bucket is None or (bucket.capacity, bucket.window) != (capacity, window):
+            tokens = bucket and bucket.tokens
+            refreshed = bucket and bucket.refreshed
+            bucket = self.buckets[key] = TokenBucket(key, capacity, window, tokens, refreshed)
+        return bucket
+
+    def consume(self, key, capacity, window):
+        '''
+        Takes one call from the budget of key, raises FeedDeferredException
+        with the seconds to wait when there is none left.
+        '''
+        with self.lock:
+            bucket = self.get_bucket(key, capacity, window)
+            if not bucket.consume():
+                raise FeedDeferredException(bucket.get_wait())
+
+    def exhaust(self, key, capacity, window):
+        '''
+        Empties the budget of key, for when the remote side refused a call.
+        '''
+        with self.lock:
+            bucket = self.get_bucket(key, capacity, window)
+            bucket.exhaust()
+            return bucket.get_wait()
+
+    def remaining(self):
+        with self.lock:
+            for bucket in self.buckets.values():
+                bucket.refill()
+            return dict((key, int(bucket.tokens)) for key, bucket in self.buckets.items())
+
+    def load(self):
+        from .models import RateLimit
+        with self.lock:
+            for limit in RateLimit.objects.all():
+                bucket = self.buckets.get(limit.key)
+                if bucket is None or limit.refreshed > bucket.refreshed:
+                    self.buckets[limit.key] = TokenBucket(limit.key, limit.capacity, limit.window,
+                                                          limit.tokens, limit.refreshed)
+
+    def save(self):
+        from .models import RateLimit
+        with self.lock:
+            buckets = list(self.buckets.values())
+        with transaction.commit_on_success():
+            existing = set(RateLimit.objects.filter(key__in=[bucket.key for bucket in buckets])
+                                            .values_list('key', flat=True))
+            for bucket in buckets:
+                values = {'capacity': bucket.capacity, 'window': bucket.window,
+                          'tokens': bucket.tokens, 'refreshed': bucket.refreshed}
+                if bucket.key in existing:
+                    RateLimit.objects.filter(key=bucket.key).update(**values)
+                else:
+                    RateLimit.objects.create(key=bucket.key, **values)
+
+    def clear(self):
+        with self.lock:
+            self.buckets = {}
+
+
+rate_limiter = RateLimiter()
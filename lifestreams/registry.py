@@ -0,0 +1,48 @@
+from django.core.exceptions import ImproperlyConfigured
+
+from .utils import get_setting, split_class_name, get_class
+
+
+class PluginRegistry(object):
+    '''
+    Plugin classes by dotted path, each path is imported only once per process.
+    '''
+
+    def __init__(self):
+        self.plugins = {}
+        self.populated = False
+
+    def populate(self):
+        if self.populated:
+            return
+        from .plugins import BasePlugin
+        for path, name in get_setting('LIFESTREAMS_PLUGIN_CHOICES'):
+            PluginClass = self.register(path)
+            if not (isinstance(PluginClass, type) and issubclass(PluginClass, BasePlugin)):
+                raise ImproperlyConfigured('Lifestreams plugin %s must subclass BasePlugin.' % path)
+        self.populated = True
+
+    def register(self, path):
+        try:
+            PluginClass = get_class(*split_class_name(path))
+        except (ImportError, AttributeError), e:
+            raise ImproperlyConfigured('Error importing lifestreams plugin %s: "%s"' % (path, e))
+        self.plugins[path] = PluginClass
+        return PluginClass
+
+    def get(self, path):
+        try:
+            return self.plugins[path]
+        except KeyError:
+            self.populate()
+        try:
+            return self.plugins[path]
+        except KeyError:
+            return self.register(path)
+
+    def clear(self):
+        self.plugins = {}
+        self.populated = False
+
+
+registry = PluginRegistry()
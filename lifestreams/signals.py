@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent by update_lifestreams around each run.
+update_started = Signal()
+update_finished = Signal(providing_args=['stats'])
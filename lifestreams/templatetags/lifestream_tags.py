@@ -1,8 +1,20 @@
 from django import template
 
+from lifestreams.models import render_items, render_timeline
+
 register = template.Library()
 
 
 @register.simple_tag
 def lifestream_render(item, template_suffix=None):
 	return item.render() if template_suffix is None else item.render(template_suffix)
+
+
+@register.simple_tag
+def lifestream_render_items(items, template_suffix=''):
+	return render_items(items, template_suffix)
+
+
+@register.simple_tag
+def lifestream_render_timeline(lifestream, limit=20, template_suffix=''):
+	return render_timeline(getattr(lifestream, 'name', lifestream), limit, template_suffix)
@@ -1,18 +1,33 @@
 import doctest
+import json
+import os
+import signal
+import socket
+import tempfile
+import threading
 import unittest
+from datetime import timedelta
 
 from django.test import TestCase
 from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.core.management import call_command
+from django.core.urlresolvers import reverse
 from django.utils.timezone import now
 from django.template import Template, Context
+from django.test.utils import override_settings
 
 from mock import patch, Mock
 
-from .utils import get_setting, DEFAULT_SETTINGS
-from .models import Feed, Lifestream, Item
+from .utils import get_setting, decode_cursor, DEFAULT_SETTINGS
+from .models import (Feed, Lifestream, Item, RateLimit, TimelineEntry, render_items, render_timeline,
+                     claim_feeds, extend_lease, release_feeds)
+from .cache import get_backend, get_version, get_version_key, get_stats, reset_stats
 from .plugins import BasePlugin
-from .exceptions import FeedNotConfiguredException, FeedErrorException
+from .registry import registry, PluginRegistry
+from .ratelimit import rate_limiter, RateLimiter
+from .exceptions import FeedNotConfiguredException, FeedErrorException, InvalidCursorException, FeedDeferredException
 
 
 class UtilsTest(TestCase):
@@ -80,6 +95,89 @@ class LifestreamModelTest(TestCase):
 
         self.assertQuerysetEqual(result, map(repr, items))
 
+    def test_get_items_paginated(self):
+        lifestream = Lifestream.objects.create(name='lifestream')
+        feed1 = Feed.objects.create(lifestream=lifestream, title='feed1')
+        feed2 = Feed.objects.create(lifestream=lifestream, title='feed2')
+        published = now()
+        for i in range(3):
+            Item.objects.create(feed=feed1, published=published - timedelta(hours=i))
+            Item.objects.create(feed=feed2, published=published - timedelta(hours=i))
+        Item.objects.create(feed=feed2, published=published - timedelta(hours=1))
+        expected = list(Item.objects.order_by('-published', '-id'))
+
+        pages = []
+        cursor = None
+        while True:
+            page = list(lifestream.get_items(before=cursor, limit=3))
+            if not page:
+                break
+            pages.append(page)
+            cursor = page[-1].get_cursor()
+
+        self.assertEqual([3, 3, 1], [len(items) for items in pages])
+        self.assertEqual(expected, sum(pages, []))
+
+    def test_get_items_limit(self):
+        lifestream = Lifestream.objects.create(name='lifestream')
+        feed = Feed.objects.create(lifestream=lifestream, title='feed')
+        for i in range(3):
+            Item.objects.create(feed=feed, published=now())
+
+        result = lifestream.get_items(limit=2)
+
+        self.assertEqual(list(Item.objects.order_by('-published', '-id')[:2]), list(result))
+
+    def test_get_items_invalid_cursor(self):
+        lifestream = Lifestream.objects.create(name='lifestream')
+
+        self.assertRaises(InvalidCursorException, lifestream.get_items, before='invalid')
+
+    def test_get_merged_items(self):
+        lifestream = Lifestream.objects.create(name='lifestream')
+        published = now()
+        for i in range(3):
+            feed = Feed.objects.create(lifestream=lifestream, title='feed%d' % i)
+            for j in range(4):
+                Item.objects.create(feed=feed, published=published - timedelta(hours=j * (i + 1)))
+
+        pages = []
+        cursor = None
+        for i in range(4):
+            page = lifestream.get_merged_items(limit=5, before=cursor)
+            self.assertEqual(list(lifestream.get_items(limit=5, before=cursor)), page)
+            pages.append(len(page))
+            cursor = page and page[-1].get_cursor()
+        self.assertEqual([5, 5, 2, 0], pages)
+
+    def test_get_merged_items_lazily(self):
+        lifestream = Lifestream.objects.create(name='lifestream')
+        feed1 = Feed.objects.create(lifestream=lifestream, title='feed1')
+        feed2 = Feed.objects.create(lifestream=lifestream, title='feed2')
+        published = now()
+        for i in range(10):
+            Item.objects.create(feed=feed1, published=published - timedelta(minutes=i))
+            Item.objects.create(feed=feed2, published=published - timedelta(days=1, minutes=i))
+
+        with self.assertNumQueries(4):
+            items = lifestream.get_merged_items(limit=6, chunk_size=3)
+
+        self.assertEqual(list(feed1.items.order_by('-published')[:6]), items)
+        with self.assertNumQueries(0):
+            self.assertEqual(feed1, items[0].feed)
+
+    def test_get_merged_items_no_feeds(self):
+        lifestream = Lifestream.objects.create(name='lifestream')
+
+        self.assertEqual([], lifestream.get_merged_items(limit=5))
+
+    def test_item_cursor(self):
+        lifestream = Lifestream.objects.create(name='lifestream')
+        feed = Feed.objects.create(lifestream=lifestream, title='feed')
+        item = Item.objects.create(feed=feed, published=now())
+
+        self.assertEqual((item.published, item.pk), decode_cursor(item.get_cursor()))
+
 
 class LifestreamTagsTest(TestCase):
     def setUp(self):
@@ -118,6 +216,123 @@ class LifestreamTagsTest(TestCase):
         self.assertEqual(expected, result)
         render.assert_called_once_with('suffix/')
 
+    @patch('lifestreams.templatetags.lifestream_tags.render_items')
+    def test_lifestream_render_items(self, render_items):
+        template = "{% load lifestream_tags %}" \
+                   "{% lifestream_render_items items %}"
+        context = Context({'items': [self.item]})
+
+        result = Template(template).render(context)
+
+        self.assertEqual(unicode(render_items.return_value), result)
+        render_items.assert_called_once_with([self.item], '')
+
+    @patch('lifestreams.templatetags.lifestream_tags.render_timeline')
+    def test_lifestream_render_timeline(self, render_timeline):
+        template = "{% load lifestream_tags %}" \
+                   "{% lifestream_render_timeline lifestream 10 'suffix/' %}"
+        context = Context({'lifestream': self.item.feed.lifestream})
+
+        result = Template(template).render(context)
+
+        self.assertEqual(unicode(render_timeline.return_value), result)
+        render_timeline.assert_called_once_with('lifestream', 10, 'suffix/')
+
+    @patch('lifestreams.templatetags.lifestream_tags.render_items')
+    def test_lifestream_render_items_custom_template(self, render_items):
+        template = "{% load lifestream_tags %}" \
+                   "{% lifestream_render_items items 'suffix/' %}"
+        context = Context({'items': [self.item]})
+
+        Template(template).render(context)
+
+        render_items.assert_called_once_with([self.item], 'suffix/')
+
+
+class RenderItemsTest(TestCase):
+    def setUp(self):
+        lifestream = Lifestream.objects.create(name='lifestream')
+        for title in ('feed1', 'feed2', 'feed3'):
+            feed = Feed.objects.create(lifestream=lifestream, title=title, feed_plugin='lifestreams.tests.TemplatePlugin')
+            for i in range(5):
+                feed.items.create(published=now(), link='http://witoi.com/%s/%d' % (title, i))
+        self.lifestream = lifestream
+
+    @patch('lifestreams.models.get_template')
+    def test_render_items(self, get_template):
+        get_template.return_value = Template('{{ item.link }}|{{ item.feed.title }};')
+        items = self.lifestream.get_items()
+
+        with self.assertNumQueries(2):
+            result = render_items(items)
+
+        expected = ''.join('%s|%s;' % (item.link, item.feed.title) for item in items)
+        self.assertEqual(expected, result)
+        get_template.assert_called_once_with('lifestreams/template/item.html')
+
+    @patch('lifestreams.models.get_template')
+    def test_render_items_with_suffix(self, get_template):
+        get_template.return_value = Template('{{ item.link }}')
+
+        render_items(self.lifestream.get_items(), 'suffix/')
+
+        get_template.assert_called_once_with('suffix/lifestreams/template/item.html')
+
+    @patch('lifestreams.models.get_template')
+    def test_render_timeline(self, get_template):
+        get_template.return_value = Template('{{ item.link }};')
+        cache.clear()
+        reset_stats()
+        self.addCleanup(reset_stats)
+        expected = render_items(self.lifestream.get_items(limit=5))
+
+        self.assertEqual(expected, render_timeline('lifestream', limit=5))
+        with self.assertNumQueries(0):
+            self.assertEqual(expected, render_timeline('lifestream', limit=5))
+        self.assertEqual({'hits': 1, 'misses': 1}, get_stats())
+
+        feed = self.lifestream.feeds.all()[0]
+        feed.items.create(published=now(), link='http://witoi.com/new')
+        self.assertTrue(render_timeline('lifestream', limit=5).startswith('http://witoi.com/new;'))
+        self.assertEqual({'hits': 1, 'misses': 2}, get_stats())
+
+    @override_settings(LIFESTREAMS_CACHE='timeline',
+                       CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                               'timeline': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                            'LOCATION': 'timeline'}})
+    @patch('lifestreams.models.get_template')
+    def test_render_timeline_cache_alias(self, get_template):
+        get_template.return_value = Template('{{ item.link }};')
+        cache.clear()
+
+        render_timeline('lifestream')
+
+        self.assertTrue(get_backend().get(get_version_key('lifestream')))
+        self.assertEqual(None, cache.get(get_version_key('lifestream')))
+
+    @override_settings(LIFESTREAMS_CACHE='local',
+                       CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                               'local': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                         'LOCATION': 'local'}})
+    @patch('lifestreams.cache.logger')
+    def test_process_local_cache_warning(self, logger):
+        get_backend()
+        get_backend()
+
+        self.assertEqual(1, logger.warn.call_count)
+        self.assertEqual('local', logger.warn.call_args[0][1])
+
+    def test_render_timeline_unknown_lifestream(self):
+        self.assertEqual('', render_timeline('unknown'))
+
+    @patch('lifestreams.models.get_template')
+    def test_render_items_empty(self, get_template):
+        with self.assertNumQueries(0):
+            result = render_items(Item.objects.none())
+
+        self.assertEqual('', result)
+        self.assertFalse(get_template.called)
+
 
 class ItemModelTest(TestCase):
     @patch('lifestreams.plugins.BasePlugin')
@@ -161,6 +376,9 @@ class ItemModelTest(TestCase):
 
 class FeedModelTest(TestCase): 
     def setUp(self):
+        registry.clear()
+        registry.populate()
+        self.addCleanup(registry.clear)
         self.plugin = 'lifestreams.plugins.BasePlugin'
         lifestream = Lifestream.objects.create(name='dummy')
         self.feed = Feed(title=self.plugin, feed_plugin=self.plugin, lifestream=lifestream)
@@ -178,6 +396,55 @@ class FeedModelTest(TestCase):
             instance.update.assert_called_once_with()
             self.assertEqual(instance, return_value)
 
+    @override_settings(LIFESTREAMS_MIN_FETCH_INTERVAL=60, LIFESTREAMS_MAX_FETCH_INTERVAL=3600)
+    def test_schedule_without_new_items(self):
+        self.feed.save()
+
+        self.feed.schedule()
+        self.assertEqual(120, self.feed.fetch_interval)
+        self.feed.schedule()
+        self.assertEqual(240, self.feed.fetch_interval)
+        for i in range(5):
+            self.feed.schedule()
+
+        feed = Feed.objects.get(pk=self.feed.pk)
+        self.assertEqual(3600, feed.fetch_interval)
+        self.assertEqual(self.feed.next_fetch_at, feed.next_fetch_at)
+        self.assertTrue(feed.next_fetch_at > now() + timedelta(seconds=3500))
+
+    @override_settings(LIFESTREAMS_MIN_FETCH_INTERVAL=60, LIFESTREAMS_MAX_FETCH_INTERVAL=24 * 3600)
+    def test_schedule_with_new_items(self):
+        self.feed.fetch_interval = 24 * 3600
+        self.feed.save()
+        published = now()
+        for i in range(4):
+            self.feed.items.create(published=published - timedelta(hours=2 * i))
+
+        self.feed.schedule(new_items=1)
+
+        self.assertEqual(3600, Feed.objects.get(pk=self.feed.pk).fetch_interval)
+
+    @override_settings(LIFESTREAMS_MIN_FETCH_INTERVAL=60, LIFESTREAMS_MAX_FETCH_INTERVAL=24 * 3600)
+    def test_schedule_with_first_item(self):
+        self.feed.fetch_interval = 24 * 3600
+        self.feed.save()
+        self.feed.items.create(published=now())
+
+        self.feed.schedule(new_items=1)
+
+        self.assertEqual(60, self.feed.fetch_interval)
+
+    @override_settings(LIFESTREAMS_MIN_FETCH_INTERVAL=60, LIFESTREAMS_MAX_FETCH_INTERVAL=24 * 3600)
+    def test_schedule_busy_feed(self):
+        self.feed.save()
+        published = now()
+        for i in range(20):
+            self.feed.items.create(published=published - timedelta(seconds=10 * i))
+
+        self.feed.schedule(new_items=20)
+
+        self.assertEqual(60, self.feed.fetch_interval)
+
     def test_update_feed_not_fetchable(self):
         self.feed.fetchable = False
         self.feed.save()
@@ -188,6 +455,47 @@ class FeedModelTest(TestCase):
 
             self.assertFalse(instance.update.called)
 
+    def test_claim_feeds(self):
+        self.feed.save()
+        for title in ('feed2', 'feed3'):
+            Feed.objects.create(title=title, feed_plugin=self.plugin, lifestream=self.feed.lifestream)
+
+        first = claim_feeds(Feed.objects.all(), 'worker1', 2, 60)
+        second = claim_feeds(Feed.objects.all(), 'worker2', 2, 60)
+
+        self.assertEqual(2, len(first))
+        self.assertEqual(1, len(second))
+        self.assertEqual(set(), set(first) & set(second))
+        self.assertEqual([], claim_feeds(Feed.objects.all(), 'worker3', 2, 60))
+        self.assertEqual('worker2', Feed.objects.get(pk=second[0].pk).lease_owner)
+
+    def test_claim_expired_lease(self):
+        self.feed.lease_owner = 'worker1'
+        self.feed.lease_expires = now() - timedelta(seconds=1)
+        self.feed.save()
+
+        self.assertEqual([self.feed], claim_feeds(Feed.objects.all(), 'worker2', 10, 60))
+
+    def test_extend_lease(self):
+        self.feed.save()
+        feed, = claim_feeds(Feed.objects.all(), 'worker1', 10, 1)
+
+        self.assertTrue(extend_lease(feed, 'worker1', 600))
+        self.assertFalse(extend_lease(feed, 'worker2', 600))
+        self.assertTrue(Feed.objects.get(pk=feed.pk).lease_expires > now() + timedelta(seconds=500))
+
+    def test_release_feeds(self):
+        self.feed.save()
+        feeds = claim_feeds(Feed.objects.all(), 'worker1', 10, 60)
+
+        release_feeds(feeds, 'worker2')
+        self.assertEqual([], claim_feeds(Feed.objects.all(), 'worker2', 10, 60))
+        release_feeds(feeds, 'worker1')
+
+        feed = Feed.objects.get(pk=self.feed.pk)
+        self.assertEqual(('', None), (feed.lease_owner, feed.lease_expires))
+        self.assertEqual([self.feed], claim_feeds(Feed.objects.all(), 'worker2', 10, 60))
+
 
 class BasePluginTest(TestCase):
     def setUp(self):
@@ -237,17 +545,128 @@ class BasePluginTest(TestCase):
         self.assertEqual(handler, plugin.handler)
 
     @patch('lifestreams.plugins.BasePlugin.get_update_kwargs')
-    @patch('lifestreams.plugins.BasePlugin.create_item')
+    @patch('lifestreams.plugins.BasePlugin.build_item')
     @patch('lifestreams.plugins.BasePlugin.get_handler')
-    def test_update_create_item_called(self, get_handler, create_item, get_update_kwargs):
+    def test_update_build_item_called(self, get_handler, build_item, get_update_kwargs):
         handler = get_handler.return_value
         item = Mock()
         handler.update.return_value = [item]
+        build_item.return_value = None
         plugin = BasePlugin(feed=self.feed)
 
         plugin.update()
 
-        create_item.assert_called_once_with(item)
+        build_item.assert_called_once_with(item)
+
+    @patch('lifestreams.plugins.BasePlugin.get_update_kwargs')
+    @patch('lifestreams.plugins.BasePlugin.get_handler')
+    def test_fetch(self, get_handler, get_update_kwargs):
+        handler = get_handler.return_value
+        plugin = BasePlugin(feed=self.feed)
+
+        result = plugin.fetch()
+
+        self.assertEqual(handler.update.return_value, result)
+        handler.update.assert_called_once_with(**get_update_kwargs.return_value)
+
+    @patch('lifestreams.plugins.BasePlugin.build_item')
+    def test_save(self, build_item):
+        entries = [Mock(), Mock()]
+        build_item.return_value = None
+        plugin = BasePlugin(feed=self.feed)
+
+        result = plugin.save(entries)
+
+        self.assertEqual(plugin, result)
+        self.assertEqual(2, build_item.call_count)
+
+    def test_save_bulk(self):
+        self.feed.save()
+        entries = ['http://witoi.com/%d' % i for i in range(250)]
+        plugin = LinkPlugin(feed=self.feed)
+
+        with self.assertNumQueries(8):
+            plugin.save(entries)
+
+        self.assertEqual(250, self.feed.items.count())
+
+    def test_save_bulk_related(self):
+        self.feed.save()
+        entries = ['http://witoi.com/%d' % i for i in range(150)]
+        plugin = LinkPlugin(feed=self.feed)
+        plugin.related_model = Feed
+
+        with self.assertNumQueries(8):
+            with patch.object(Feed.objects, 'bulk_create') as bulk_create:
+                plugin.save(entries)
+
+        self.assertEqual(2, bulk_create.call_count)
+        related = bulk_create.call_args[0][0]
+        self.assertEqual(50, len(related))
+        for item in related:
+            self.assertEqual(Item.objects.get(link=item.link).pk, item.pk)
+
+    def test_save_partial_bumps_version(self):
+        self.feed.save()
+        cache.clear()
+        version = get_version(self.feed.lifestream.name)
+
+        def entries():
+            for i in range(150):
+                yield 'http://witoi.com/%d' % i
+            raise FeedErrorException()
+
+        self.assertRaises(FeedErrorException, LinkPlugin(feed=self.feed).save, entries())
+
+        self.assertEqual(100, self.feed.items.count())
+        self.assertNotEqual(version, get_version(self.feed.lifestream.name))
+
+    def test_save_skipped_entries(self):
+        self.feed.save()
+        plugin = LinkPlugin(feed=self.feed)
+
+        with self.assertNumQueries(1):
+            plugin.save([None, None])
+
+        self.assertEqual(0, self.feed.items.count())
+
+    def test_save_last_entry(self):
+        self.feed.save()
+        plugin = LinkPlugin(feed=self.feed)
+        plugin.get_entry_id = lambda link: link.upper()
+
+        plugin.save(['http://witoi.com/1', 'http://witoi.com/2'])
+
+        last = self.feed.items.latest('published')
+        feed = Feed.objects.get(pk=self.feed.pk)
+        self.assertEqual('HTTP://WITOI.COM/2', feed.last_id)
+        self.assertEqual(last.published, feed.last_published)
+        self.assertEqual(feed.last_id, self.feed.last_id)
+
+    def test_save_last_entry_older_entries(self):
+        self.feed.last_id = 'newer'
+        self.feed.last_published = now() + timedelta(days=1)
+        self.feed.save()
+        plugin = LinkPlugin(feed=self.feed)
+
+        plugin.save(['http://witoi.com/1'])
+
+        feed = Feed.objects.get(pk=self.feed.pk)
+        self.assertEqual('newer', feed.last_id)
+        self.assertEqual(self.feed.last_published, feed.last_published)
+
+    def test_get_entry_id(self):
+        plugin = BasePlugin(feed=self.feed)
+
+        self.assertIsNone(plugin.get_entry_id(Mock()))
+
+    def test_create_item(self):
+        self.feed.save()
+        plugin = LinkPlugin(feed=self.feed)
+
+        plugin.create_item('http://witoi.com')
+
+        self.assertEqual('http://witoi.com', self.feed.items.get().link)
 
     def test_not_implemented_get_handler(self):
         plugin = BasePlugin(feed=self.feed)
@@ -259,6 +678,16 @@ class BasePluginTest(TestCase):
 
         self.assertRaises(NotImplementedError, plugin.create_item, None)
 
+    def test_not_implemented_build_item(self):
+        plugin = BasePlugin(feed=self.feed)
+
+        self.assertRaises(NotImplementedError, plugin.build_item, None)
+
+    def test_not_implemented_build_related(self):
+        plugin = BasePlugin(feed=self.feed)
+
+        self.assertRaises(NotImplementedError, plugin.build_related, None, None)
+
     def test_not_implemented_get_update_kwargs(self):
         plugin = BasePlugin(feed=self.feed)
 
@@ -272,7 +701,11 @@ class BasePluginTest(TestCase):
 
 class UpdateLifestreamsCommandTest(TestCase):
     def setUp(self):
-        pass
+        registry.clear()
+        registry.populate()
+        self.addCleanup(registry.clear)
+        rate_limiter.clear()
+        self.addCleanup(rate_limiter.clear)
 
     @patch('lifestreams.models.Feed.update')
     def test_no_feeds(self, update):
@@ -387,11 +820,595 @@ class UpdateLifestreamsCommandTest(TestCase):
         DummyPlugin.return_value.update.assert_called_once_with()
         self.assertFalse(BasePlugin.called)
 
+    @patch('lifestreams.tests.DummyPlugin')
+    def test_workers(self, DummyPlugin):
+        lifestream = Lifestream.objects.create(name='dummy')
+        plugin = DummyPlugin.return_value
+        plugin.fetch.return_value = [Mock()]
+        for title in ('feed1', 'feed2', 'feed3'):
+            Feed.objects.create(title=title, feed_plugin='lifestreams.tests.DummyPlugin', lifestream=lifestream)
+
+        call_command('update_lifestreams', workers=2)
+
+        self.assertEqual(3, plugin.fetch.call_count)
+        self.assertEqual(3, plugin.save.call_count)
+        plugin.save.assert_called_with(plugin.fetch.return_value)
+        self.assertFalse(plugin.update.called)
+
+    @patch('lifestreams.tests.DummyPlugin')
+    def test_workers_feed_error(self, DummyPlugin):
+        lifestream = Lifestream.objects.create(name='dummy')
+        plugin = DummyPlugin.return_value
+        plugin.fetch.side_effect = FeedErrorException
+        Feed.objects.create(title='feed1', feed_plugin='lifestreams.tests.DummyPlugin', lifestream=lifestream)
+        Feed.objects.create(title='feed2', feed_plugin='lifestreams.tests.DummyPlugin', lifestream=lifestream)
+
+        call_command('update_lifestreams', workers=2)
+
+        self.assertEqual(2, plugin.fetch.call_count)
+        self.assertFalse(plugin.save.called)
+
+    @patch('lifestreams.tests.DummyPlugin')
+    def test_workers_feed_not_fetchable(self, DummyPlugin):
+        lifestream = Lifestream.objects.create(name='dummy')
+        Feed.objects.create(title='feed', feed_plugin='lifestreams.tests.DummyPlugin',
+                            lifestream=lifestream, fetchable=False)
+
+        call_command('update_lifestreams', workers=2)
+
+        self.assertFalse(DummyPlugin.called)
+
+    @patch('lifestreams.tests.DummyPlugin')
+    def test_due(self, DummyPlugin):
+        lifestream = Lifestream.objects.create(name='dummy')
+        feed_plugin = 'lifestreams.tests.DummyPlugin'
+        Feed.objects.create(title='new', feed_plugin=feed_plugin, lifestream=lifestream)
+        Feed.objects.create(title='due', feed_plugin=feed_plugin, lifestream=lifestream,
+                            next_fetch_at=now() - timedelta(minutes=1))
+        Feed.objects.create(title='not due', feed_plugin=feed_plugin, lifestream=lifestream,
+                            next_fetch_at=now() + timedelta(minutes=1))
+
+        call_command('update_lifestreams', due=True)
+
+        feeds = [call[1]['feed'].title for call in DummyPlugin.call_args_list]
+        self.assertEqual(['new', 'due'], feeds)
+
+    @patch('lifestreams.management.commands.update_lifestreams.logger')
+    @patch('lifestreams.tests.DummyPlugin')
+    def test_summary(self, DummyPlugin, logger):
+        lifestream = Lifestream.objects.create(name='dummy')
+        DummyPlugin.return_value.update.side_effect = [Mock(not_modified=False), Mock(not_modified=True),
+                                                       FeedErrorException, FeedDeferredException(60)]
+        for title in ('feed1', 'feed2', 'feed3', 'feed4'):
+            Feed.objects.create(title=title, feed_plugin='lifestreams.tests.DummyPlugin', lifestream=lifestream)
+        rate_limiter.consume('api', 10, 60)
+
+        call_command('update_lifestreams')
+
+        stats = logger.info.call_args_list[-2][0][1]
+        self.assertEqual({'updated': 1, 'not_modified': 1, 'not_configured': 0, 'error': 1, 'deferred': 1,
+                          'lost': 0}, stats)
+        logger.info.assert_called_with('%d calls left for %s.', 9, 'api')
+
+    @patch('lifestreams.tests.DummyPlugin')
+    def test_deferred_feed(self, DummyPlugin):
+        lifestream = Lifestream.objects.create(name='dummy')
+        DummyPlugin.return_value.update.side_effect = FeedDeferredException(120)
+        feed = Feed.objects.create(title='feed', feed_plugin='lifestreams.tests.DummyPlugin', lifestream=lifestream)
+
+        call_command('update_lifestreams', due=True)
+        call_command('update_lifestreams', due=True)
+
+        self.assertEqual(1, DummyPlugin.return_value.update.call_count)
+        next_fetch_at = Feed.objects.get(pk=feed.pk).next_fetch_at
+        self.assertTrue(now() + timedelta(seconds=110) < next_fetch_at < now() + timedelta(seconds=130))
+
+    @override_settings(LIFESTREAMS_MIN_FETCH_INTERVAL=60)
+    @patch('lifestreams.tests.DummyPlugin')
+    def test_failing_feeds_back_off(self, DummyPlugin):
+        lifestream = Lifestream.objects.create(name='dummy')
+        DummyPlugin.return_value.update.side_effect = [FeedErrorException, FeedNotConfiguredException]
+        for title in ('error', 'not configured'):
+            Feed.objects.create(title=title, feed_plugin='lifestreams.tests.DummyPlugin', lifestream=lifestream)
+
+        call_command('update_lifestreams', due=True)
+        call_command('update_lifestreams', due=True)
+
+        self.assertEqual(2, DummyPlugin.return_value.update.call_count)
+        for feed in Feed.objects.all():
+            self.assertEqual(120, feed.fetch_interval)
+            self.assertTrue(feed.next_fetch_at > now() + timedelta(seconds=100))
+
+    @patch('lifestreams.management.commands.update_lifestreams.sleep')
+    @patch('lifestreams.tests.DummyPlugin')
+    def test_daemon(self, DummyPlugin, sleep):
+        lifestream = Lifestream.objects.create(name='dummy')
+        Feed.objects.create(title='feed1', feed_plugin='lifestreams.tests.DummyPlugin', lifestream=lifestream)
+        Feed.objects.create(title='feed2', feed_plugin='lifestreams.tests.DummyPlugin', lifestream=lifestream,
+                            next_fetch_at=now() + timedelta(hours=1))
+        DummyPlugin.return_value.update.return_value = None
+        sleeps = []
+
+        def stop(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 3:
+                os.kill(os.getpid(), signal.SIGTERM)
+        sleep.side_effect = stop
+        heartbeat = tempfile.NamedTemporaryFile()
+        handler = signal.getsignal(signal.SIGTERM)
+
+        call_command('update_lifestreams', daemon=True, interval=2, heartbeat=heartbeat.name)
+
+        self.assertEqual(3, len(sleeps))
+        self.assertEqual(2, DummyPlugin.return_value.update.call_count)
+        self.assertTrue(heartbeat.read().startswith(str(now().year)))
+        self.assertEqual(handler, signal.getsignal(signal.SIGTERM))
+
+    @patch('lifestreams.management.commands.update_lifestreams.sleep')
+    @patch('lifestreams.tests.DummyPlugin')
+    def test_daemon_finishes_feed_on_sigterm(self, DummyPlugin, sleep):
+        lifestream = Lifestream.objects.create(name='dummy')
+        for title in ('feed1', 'feed2'):
+            Feed.objects.create(title=title, feed_plugin='lifestreams.tests.DummyPlugin', lifestream=lifestream)
+
+        def update():
+            os.kill(os.getpid(), signal.SIGTERM)
+        DummyPlugin.return_value.update.side_effect = update
+
+        call_command('update_lifestreams', daemon=True)
+
+        self.assertEqual(1, DummyPlugin.return_value.update.call_count)
+        self.assertFalse(sleep.called)
+
+    @patch('lifestreams.management.commands.update_lifestreams.sleep')
+    @patch('lifestreams.tests.DummyPlugin')
+    def test_daemon_finishes_fetch_on_sigterm(self, DummyPlugin, sleep):
+        lifestream = Lifestream.objects.create(name='dummy')
+        Feed.objects.create(title='feed', feed_plugin='lifestreams.tests.DummyPlugin', lifestream=lifestream)
+        local, remote = socket.socketpair()
+        self.addCleanup(local.close)
+        self.addCleanup(remote.close)
+
+        def respond():
+            os.kill(os.getpid(), signal.SIGTERM)
+            remote.sendall('feed')
+        received = []
+
+        def update():
+            threading.Timer(0.2, respond).start()
+            received.append(local.recv(4))
+        DummyPlugin.return_value.update.side_effect = update
+
+        call_command('update_lifestreams', daemon=True)
+
+        self.assertEqual(['feed'], received)
+        self.assertFalse(sleep.called)
+
+    @patch('lifestreams.management.commands.update_lifestreams.sleep')
+    @patch('lifestreams.tests.DummyPlugin')
+    def test_daemon_survives_errors(self, DummyPlugin, sleep):
+        lifestream = Lifestream.objects.create(name='dummy')
+        Feed.objects.create(title='feed', feed_plugin='lifestreams.tests.DummyPlugin', lifestream=lifestream)
+        DummyPlugin.return_value.update.side_effect = ValueError
+        sleep.side_effect = lambda seconds: os.kill(os.getpid(), signal.SIGTERM)
+
+        call_command('update_lifestreams', daemon=True, interval=1)
+
+        self.assertEqual(1, DummyPlugin.return_value.update.call_count)
+
+    @patch('lifestreams.tests.DummyPlugin')
+    def test_leased_feeds_skipped(self, DummyPlugin):
+        lifestream = Lifestream.objects.create(name='dummy')
+        feed_plugin = 'lifestreams.tests.DummyPlugin'
+        Feed.objects.create(title='free', feed_plugin=feed_plugin, lifestream=lifestream)
+        Feed.objects.create(title='leased', feed_plugin=feed_plugin, lifestream=lifestream,
+                            lease_owner='other', lease_expires=now() + timedelta(minutes=1))
+
+        call_command('update_lifestreams')
+
+        feeds = [call[1]['feed'].title for call in DummyPlugin.call_args_list]
+        self.assertEqual(['free'], feeds)
+        self.assertEqual(['', 'other'], list(Feed.objects.order_by('title').values_list('lease_owner', flat=True)))
+
+    @patch('lifestreams.tests.DummyPlugin')
+    def test_lease_renewed_before_each_feed(self, DummyPlugin):
+        lifestream = Lifestream.objects.create(name='dummy')
+        for title in ('feed1', 'feed2', 'feed3'):
+            Feed.objects.create(title=title, feed_plugin='lifestreams.tests.DummyPlugin', lifestream=lifestream)
+        expires = []
+
+        def update():
+            feed = DummyPlugin.call_args[1]['feed']
+            expires.append(Feed.objects.get(pk=feed.pk).lease_expires)
+            # Another worker takes the last feed after the lease expired.
+            Feed.objects.filter(title='feed3').update(lease_owner='other')
+        DummyPlugin.return_value.update.side_effect = update
+
+        with self.settings(LIFESTREAMS_LEASE_SECONDS=600):
+            call_command('update_lifestreams')
+
+        self.assertEqual(2, DummyPlugin.return_value.update.call_count)
+        self.assertTrue(expires[0] <= expires[1])
+        self.assertEqual('other', Feed.objects.get(title='feed3').lease_owner)
+
+    @patch('lifestreams.tests.DummyPlugin')
+    def test_batches(self, DummyPlugin):
+        lifestream = Lifestream.objects.create(name='dummy')
+        for i in range(5):
+            Feed.objects.create(title='feed%d' % i, feed_plugin='lifestreams.tests.DummyPlugin',
+                                lifestream=lifestream)
+
+        call_command('update_lifestreams', batch_size=2)
+
+        self.assertEqual(5, DummyPlugin.return_value.update.call_count)
+        self.assertFalse(Feed.objects.filter(lease_expires__isnull=False).exists())
+
+    def test_rate_limits_persisted(self):
+        rate_limiter.consume('api', 10, 60)
+
+        call_command('update_lifestreams')
+        rate_limiter.clear()
+        call_command('update_lifestreams')
+
+        self.assertEqual(9, rate_limiter.remaining()['api'])
+        self.assertEqual(1, RateLimit.objects.count())
+
+
+class PluginRegistryTest(TestCase):
+    def setUp(self):
+        self.registry = PluginRegistry()
+
+    def test_get_plugin_in_choices(self):
+        from lifestreams.plugins.lifestream_rss.plugin import RSSPlugin
+
+        result = self.registry.get('lifestreams.plugins.lifestream_rss.plugin.RSSPlugin')
+
+        self.assertEqual(RSSPlugin, result)
+        self.assertTrue(self.registry.populated)
+
+    def test_get_plugin_not_in_choices(self):
+        result = self.registry.get('lifestreams.tests.DummyPlugin')
+
+        self.assertEqual(DummyPlugin, result)
+
+    @patch('lifestreams.registry.get_class')
+    def test_get_plugin_imported_once(self, get_class):
+        self.registry.populated = True
+
+        self.registry.get('lifestreams.tests.DummyPlugin')
+        result = self.registry.get('lifestreams.tests.DummyPlugin')
+
+        self.assertEqual(get_class.return_value, result)
+        get_class.assert_called_once_with('lifestreams.tests', 'DummyPlugin')
+
+    def test_get_inexistent_plugin(self):
+        self.assertRaises(ImproperlyConfigured, self.registry.get, 'lifestreams.tests.InexistentPlugin')
+        self.assertRaises(ImproperlyConfigured, self.registry.get, 'lifestreams.inexistent.Plugin')
+
+    @override_settings(LIFESTREAMS_PLUGIN_CHOICES=(('lifestreams.tests.DummyPlugin', 'Dummy'),
+                                                   ('lifestreams.models.Feed', 'Feed')))
+    def test_populate_invalid_plugin(self):
+        self.assertRaises(ImproperlyConfigured, self.registry.populate)
+        self.assertFalse(self.registry.populated)
+
+    @override_settings(LIFESTREAMS_PLUGIN_CHOICES=(('lifestreams.tests.DummyPlugin', 'Dummy'),))
+    def test_populate(self):
+        self.registry.populate()
+
+        self.assertEqual({'lifestreams.tests.DummyPlugin': DummyPlugin}, self.registry.plugins)
+
+    def test_clear(self):
+        self.registry.get('lifestreams.tests.DummyPlugin')
+
+        self.registry.clear()
+
+        self.assertEqual({}, self.registry.plugins)
+        self.assertFalse(self.registry.populated)
+
 
 class DummyPlugin(BasePlugin):
     pass
 
 
+class TemplatePlugin(BasePlugin):
+    def get_template_name(self):
+        return 'lifestreams/template/item.html'
+
+
+class LinkPlugin(BasePlugin):
+    def build_item(self, link):
+        if link is not None:
+            return Item(feed=self.feed, link=link, published=now())
+
+    def build_related(self, link, item):
+        return item
+
+
+class RateLimiterTest(TestCase):
+    def setUp(self):
+        self.rate_limiter = RateLimiter()
+        self.start = now()
+
+    def advance(self, seconds):
+        return patch('lifestreams.ratelimit.now', return_value=self.start + timedelta(seconds=seconds))
+
+    def test_consume(self):
+        with self.advance(0):
+            for i in range(3):
+                self.rate_limiter.consume('api', 3, 60)
+
+            self.assertEqual({'api': 0}, self.rate_limiter.remaining())
+            with self.assertRaises(FeedDeferredException) as context:
+                self.rate_limiter.consume('api', 3, 60)
+        self.assertEqual(20, context.exception.retry_after)
+
+    def test_consume_refills(self):
+        with self.advance(0):
+            for i in range(3):
+                self.rate_limiter.consume('api', 3, 60)
+        with self.advance(20):
+            self.rate_limiter.consume('api', 3, 60)
+            self.assertRaises(FeedDeferredException, self.rate_limiter.consume, 'api', 3, 60)
+        with self.advance(600):
+            self.assertEqual({'api': 3}, self.rate_limiter.remaining())
+
+    def test_keys_are_independent(self):
+        with self.advance(0):
+            self.rate_limiter.consume('api', 1, 60)
+            self.rate_limiter.consume('other', 1, 60)
+
+            self.assertRaises(FeedDeferredException, self.rate_limiter.consume, 'api', 1, 60)
+
+    def test_exhaust(self):
+        with self.advance(0):
+            self.assertEqual(6, self.rate_limiter.exhaust('api', 10, 60))
+            self.assertRaises(FeedDeferredException, self.rate_limiter.consume, 'api', 10, 60)
+
+    def test_consume_threads(self):
+        errors = []
+
+        def consume():
+            for i in range(50):
+                try:
+                    self.rate_limiter.consume('api', 100, 3600)
+                except FeedDeferredException:
+                    errors.append(i)
+
+        threads = [threading.Thread(target=consume) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(100, len(errors))
+
+    def test_save_load(self):
+        with self.advance(0):
+            self.rate_limiter.consume('api', 10, 60)
+            self.rate_limiter.save()
+            self.rate_limiter.consume('api', 10, 60)
+            self.rate_limiter.save()
+
+            rate_limiter = RateLimiter()
+            rate_limiter.load()
+
+            self.assertEqual({'api': 8}, rate_limiter.remaining())
+        self.assertEqual(1, RateLimit.objects.count())
+
+
+@override_settings(LIFESTREAMS_TIMELINE=True)
+class TimelineTest(TestCase):
+    def setUp(self):
+        self.lifestream = Lifestream.objects.create(name='lifestream')
+        self.feed1 = Feed.objects.create(lifestream=self.lifestream, title='feed1')
+        self.feed2 = Feed.objects.create(lifestream=self.lifestream, title='feed2')
+        other = Lifestream.objects.create(name='other')
+        Feed.objects.create(lifestream=other, title='other').items.create(published=now())
+
+    def test_get_items_paginated(self):
+        published = now()
+        for i in range(3):
+            Item.objects.create(feed=self.feed1, published=published - timedelta(hours=i))
+            Item.objects.create(feed=self.feed2, published=published - timedelta(hours=i))
+        expected = list(Item.objects.filter(feed__lifestream=self.lifestream).order_by('-published', '-id'))
+
+        first = list(self.lifestream.get_items(limit=4))
+        second = list(self.lifestream.get_items(before=first[-1].get_cursor(), limit=4))
+
+        self.assertEqual(expected, first + second)
+        self.assertEqual(7, TimelineEntry.objects.count())
+
+    def test_plugin_save(self):
+        plugin = LinkPlugin(feed=self.feed1)
+
+        plugin.save(['http://witoi.com/%d' % i for i in range(3)])
+
+        items = list(self.feed1.items.order_by('-published', '-id'))
+        self.assertEqual(items, list(self.lifestream.get_items(limit=10)))
+
+    def test_item_deleted(self):
+        item = self.feed1.items.create(published=now())
+
+        item.delete()
+
+        self.assertEqual([], list(self.lifestream.get_items(limit=10)))
+
+    def test_rebuild(self):
+        published = now()
+        with self.settings(LIFESTREAMS_TIMELINE=False):
+            for i in range(3):
+                self.feed1.items.create(published=published - timedelta(hours=i))
+        TimelineEntry.objects.filter(lifestream__name='other').delete()
+
+        call_command('rebuild_lifestream_timeline', 'lifestream')
+
+        self.assertEqual(list(self.feed1.items.order_by('-published', '-id')),
+                         list(self.lifestream.get_items(limit=10)))
+        self.assertEqual(0, TimelineEntry.objects.filter(lifestream__name='other').count())
+
+
+class LifestreamItemsViewTest(TestCase):
+    urls = 'lifestreams.urls'
+
+    def setUp(self):
+        cache.clear()
+        self.lifestream = Lifestream.objects.create(name='lifestream')
+        self.feed = Feed.objects.create(lifestream=self.lifestream, title='feed')
+        self.plugin = LinkPlugin(feed=self.feed)
+        self.plugin.save(['http://witoi.com/%d' % i for i in range(3)])
+        self.url = reverse('lifestream_items', args=['lifestream'])
+
+    def test_items(self):
+        response = self.client.get(self.url)
+
+        self.assertEqual('application/json', response['Content-Type'])
+        data = json.loads(response.content)
+        items = list(self.feed.items.order_by('-published', '-id'))
+        self.assertEqual([item.pk for item in items], [item['id'] for item in data['items']])
+        self.assertEqual(items[0].link, data['items'][0]['link'])
+        self.assertEqual(None, data['next'])
+
+    def test_pagination(self):
+        pages = []
+        data = {'next': ''}
+        while data['next'] is not None:
+            response = self.client.get(self.url, {'limit': 2, 'before': data['next']} if data['next'] else {'limit': 2})
+            data = json.loads(response.content)
+            pages.append(len(data['items']))
+
+        self.assertEqual([2, 1], pages)
+
+    def test_not_modified(self):
+        etag = self.client.get(self.url)['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(304, response.status_code)
+        self.plugin.save(['http://witoi.com/new'])
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+    def test_etag_changes_with_older_items(self):
+        page = {'limit': 2, 'before': json.loads(self.client.get(self.url, {'limit': 2}).content)['next']}
+        etag = self.client.get(self.url, page)['ETag']
+
+        self.feed.items.create(published=now() - timedelta(days=1), link='http://witoi.com/old')
+
+        self.assertEqual(200, self.client.get(self.url, page, HTTP_IF_NONE_MATCH=etag).status_code)
+
+    def test_etag_changes_with_deleted_items(self):
+        etag = self.client.get(self.url)['ETag']
+
+        self.feed.items.order_by('-published', '-id')[0].delete()
+
+        self.assertEqual(200, self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+    @override_settings(LIFESTREAMS_CACHE='dummy',
+                       CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                               'dummy': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+    def test_no_etag_without_cache(self):
+        response = self.client.get(self.url)
+
+        self.assertFalse(response.has_header('ETag'))
+
+    def test_etag_by_page(self):
+        self.assertNotEqual(self.client.get(self.url)['ETag'],
+                            self.client.get(self.url, {'limit': 2})['ETag'])
+
+    def test_bad_requests(self):
+        self.assertEqual(400, self.client.get(self.url, {'before': 'invalid'}).status_code)
+        self.assertEqual(400, self.client.get(self.url, {'limit': 'all'}).status_code)
+        self.assertEqual(400, self.client.get(self.url, {'limit': 0}).status_code)
+        self.assertEqual(405, self.client.post(self.url).status_code)
+
+    def test_unknown_lifestream(self):
+        response = self.client.get(reverse('lifestream_items', args=['unknown']))
+
+        self.assertEqual(404, response.status_code)
+
+
+class LifestreamFeedTest(TestCase):
+    urls = 'lifestreams.urls'
+
+    def setUp(self):
+        cache.clear()
+        self.lifestream = Lifestream.objects.create(name='lifestream')
+        self.feed = Feed.objects.create(lifestream=self.lifestream, title='feed')
+        self.plugin = LinkPlugin(feed=self.feed)
+        self.plugin.save(['http://witoi.com/%d' % i for i in range(3)])
+
+    def test_rss(self):
+        response = self.client.get(reverse('lifestream_rss', args=['lifestream']))
+
+        self.assertTrue(response['Content-Type'].startswith('application/rss+xml'))
+        self.assertContains(response, 'http://witoi.com/2')
+        self.assertTrue(response['Last-Modified'])
+
+    def test_atom(self):
+        response = self.client.get(reverse('lifestream_atom', args=['lifestream']))
+
+        self.assertTrue(response['Content-Type'].startswith('application/atom+xml'))
+        self.assertContains(response, 'http://witoi.com/2')
+
+    def test_cached_until_new_items(self):
+        url = reverse('lifestream_rss', args=['lifestream'])
+        content = self.client.get(url).content
+
+        with self.assertNumQueries(0):
+            self.assertEqual(content, self.client.get(url).content)
+        self.plugin.save(['http://witoi.com/new'])
+        self.assertContains(self.client.get(url), 'http://witoi.com/new')
+
+    def test_not_modified(self):
+        url = reverse('lifestream_rss', args=['lifestream'])
+        last_modified = self.client.get(url)['Last-Modified']
+
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+
+        self.assertEqual(304, response.status_code)
+        self.assertEqual('', response.content)
+
+    @patch('lifestreams.feeds.time')
+    def test_modified_by_older_items(self, time):
+        url = reverse('lifestream_rss', args=['lifestream'])
+        time.return_value = 1000000000
+        last_modified = self.client.get(url)['Last-Modified']
+        time.return_value += 60
+
+        self.feed.items.create(published=now() - timedelta(days=1), link='http://witoi.com/old')
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+
+        self.assertContains(response, 'http://witoi.com/old')
+        self.assertNotEqual(last_modified, response['Last-Modified'])
+
+    def test_delete_feed(self):
+        url = reverse('lifestream_rss', args=['lifestream'])
+        self.client.get(url)
+
+        self.feed.delete()
+
+        self.assertNotContains(self.client.get(url), 'http://witoi.com/2')
+        self.lifestream.delete()
+        self.assertFalse(Item.objects.exists())
+
+    def test_delete_feed_queries(self):
+        self.plugin.save(['http://witoi.com/more/%d' % i for i in range(100)])
+        version = get_version('lifestream')
+
+        # The lifestream is looked up once, not once per item.
+        with self.assertNumQueries(12):
+            Feed.objects.get(pk=self.feed.pk).delete()
+
+        self.assertNotEqual(version, get_version('lifestream'))
+
+    def test_unknown_lifestream(self):
+        response = self.client.get(reverse('lifestream_rss', args=['unknown']))
+
+        self.assertEqual(404, response.status_code)
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(doctest.DocTestSuite('lifestreams.utils'))
@@ -402,4 +1419,10 @@ def suite():
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(LifestreamModelTest))
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(LifestreamTagsTest))
     suite.addTest(unittest.TestLoader().loadTestsFromTestCase(ItemModelTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(RenderItemsTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(PluginRegistryTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(RateLimiterTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(TimelineTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(LifestreamItemsViewTest))
+    suite.addTest(unittest.TestLoader().loadTestsFromTestCase(LifestreamFeedTest))
     return suite
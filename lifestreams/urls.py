@@ -0,0 +1,12 @@
+from django.conf.urls import patterns, url
+
+from .feeds import LifestreamFeed, AtomLifestreamFeed
+
+urlpatterns = patterns('lifestreams.views',
+    url(r'^(?P<name>[^/]+)/items\.json$', 'lifestream_items', name='lifestream_items'),
+)
+
+urlpatterns += patterns('',
+    url(r'^(?P<name>[^/]+)/rss/$', LifestreamFeed(), name='lifestream_rss'),
+    url(r'^(?P<name>[^/]+)/atom/$', AtomLifestreamFeed(), name='lifestream_atom'),
+)
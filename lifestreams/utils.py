@@ -1,13 +1,34 @@
+import threading
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime, timedelta
+from itertools import islice
+
 from django.conf import settings
+from django.utils.timezone import is_aware, make_aware, make_naive, utc
+
+from .exceptions import InvalidCursorException
 
 DEFAULT_SETTINGS = {
     'LIFESTREAMS_PLUGIN_CHOICES': (
         ('lifestreams.plugins.lifestream_twitter.plugin.TwitterPlugin', 'Twitter'),
         ('lifestreams.plugins.lifestream_instagram.plugin.InstagramPlugin', 'Instagram'),
         ('lifestreams.plugins.lifestream_rss.plugin.RSSPlugin', 'RSS'),
-    )
+    ),
+    'LIFESTREAMS_MIN_FETCH_INTERVAL': 5 * 60,
+    'LIFESTREAMS_MAX_FETCH_INTERVAL': 24 * 60 * 60,
+    'LIFESTREAMS_TWITTER_RATE_LIMIT': (180, 15 * 60),
+    'LIFESTREAMS_INSTAGRAM_MAX_PAGES': 20,
+    'LIFESTREAMS_RSS_MAX_ENTRIES': 1000,
+    'LIFESTREAMS_RSS_CONNECTIONS_PER_HOST': 2,
+    'LIFESTREAMS_CLIENT_CACHE_SIZE': 100,
+    'LIFESTREAMS_LEASE_SECONDS': 15 * 60,
+    'LIFESTREAMS_TIMELINE': False,
+    'LIFESTREAMS_CACHE': 'default',
+    'LIFESTREAMS_CACHE_TIMEOUT': 24 * 60 * 60,
 }
 
+EPOCH = datetime(1970, 1, 1)
+
 
 def get_setting(name, default=None):
     if hasattr(settings, name):
@@ -35,3 +56,118 @@ def get_class(module_name, class_name):
     <class 'django.views.generic.base.TemplateView'>
     """
     return getattr(__import__(module_name, {}, {}, ['']), class_name)
+
+
+def chunks(iterable, size):
+    """
+    >>> list(chunks(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    >>> list(chunks([], 2))
+    []
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class LRUCache(object):
+    """
+    Keeps the `size` most recently used values, safe to share between threads.
+
+    >>> cache = LRUCache(2)
+    >>> cache.get_or_create('a', lambda: 1), cache.get_or_create('b', lambda: 2)
+    (1, 2)
+    >>> cache.get_or_create('a', lambda: 3), cache.get_or_create('c', lambda: 4)
+    (1, 4)
+    >>> cache.get('b') is None, cache.keys()
+    (True, ['a', 'c'])
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.values = {}
+        self.order = []
+        self.lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.values:
+                return default
+            self.order.remove(key)
+            self.order.append(key)
+            return self.values[key]
+
+    def set(self, key, value):
+        with self.lock:
+            if key in self.values:
+                self.order.remove(key)
+            self.values[key] = value
+            self.order.append(key)
+            while len(self.order) > self.size:
+                del self.values[self.order.pop(0)]
+
+    def get_or_create(self, key, factory):
+        with self.lock:
+            value = self.get(key, self)
+            if value is self:
+                value = factory()
+                self.set(key, value)
+            return value
+
+    def keys(self):
+        with self.lock:
+            return list(self.order)
+
+    def clear(self):
+        with self.lock:
+            self.values = {}
+            self.order = []
+
+    def __len__(self):
+        return len(self.order)
+
+
+def to_microseconds(published):
+    """
+    >>> to_microseconds(datetime(2013, 9, 10, 21, 48, 50, 12))
+    1378849730000012
+    """
+    if is_aware(published):
+        published = make_naive(published, utc)
+    delta = published - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def encode_cursor(published, pk):
+    """
+    >>> encode_cursor(datetime(2013, 9, 10, 21, 48, 50, 12), 42)
+    'MTM3ODg0OTczMDAwMDAxMjo0Mg'
+    """
+    return urlsafe_b64encode('%d:%d' % (to_microseconds(published), pk)).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    >>> decode_cursor('MTM3ODg0OTczMDAwMDAxMjo0Mg')
+    (datetime.datetime(2013, 9, 10, 21, 48, 50, 12, tzinfo=<UTC>), 42)
+    >>> decode_cursor('invalid')
+    Traceback (most recent call last):
+    ...
+    InvalidCursorException: invalid
+    >>> decode_cursor('OTk5OTk5OTk5OTk5OTk5OTk5OTk5OjE')
+    Traceback (most recent call last):
+    ...
+    InvalidCursorException: OTk5OTk5OTk5OTk5OTk5OTk5OTk5OjE
+    """
+    try:
+        microseconds, pk = urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)).split(':')
+        published = EPOCH + timedelta(microseconds=int(microseconds))
+        pk = int(pk)
+    except (TypeError, ValueError, OverflowError):
+        raise InvalidCursorException(cursor)
+    if settings.USE_TZ:
+        published = make_aware(published, utc)
+    return published, pk
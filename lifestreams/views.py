@@ -1 +1,62 @@
-# Create your views here.
+import json
+from hashlib import sha1
+
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.shortcuts import get_object_or_404
+from django.views.decorators.http import condition, require_safe
+
+from .cache import get_version
+from .models import Lifestream
+from .exceptions import InvalidCursorException
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+
+def items_etag(request, name):
+    '''
+    Changes with the cached version of the lifestream, bumped whenever its
+    items are saved or deleted, so a matching If-None-Match is answered
+    without querying the database.
+    '''
+    version = get_version(name)
+    if version is None:
+        return None
+    key = '%s:%s:%s' % (name, version, request.GET.urlencode())
+    return sha1(key.encode('utf-8')).hexdigest()
+
+
+@require_safe
+@condition(etag_func=items_etag)
+def lifestream_items(request, name):
+    '''
+    A page of the items of a lifestream as JSON, newest first. The next page
+    is requested passing the returned cursor as before.
+    '''
+    lifestream = get_object_or_404(Lifestream, name=name)
+    try:
+        limit = min(int(request.GET.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+    except ValueError:
+        return HttpResponseBadRequest('Invalid limit.')
+    if limit < 1:
+        return HttpResponseBadRequest('Invalid limit.')
+    try:
+        items = list(lifestream.get_items(before=request.GET.get('before'), limit=limit))
+    except InvalidCursorException:
+        return HttpResponseBadRequest('Invalid cursor.')
+    data = {
+        'items': [serialize_item(item) for item in items],
+        'next': len(items) == limit and items[-1].get_cursor() or None,
+    }
+    return HttpResponse(json.dumps(data, separators=(',', ':')), content_type='application/json')
+
+
+def serialize_item(item):
+    return {
+        'id': item.pk,
+        'feed': item.feed_id,
+        'author': item.author,
+        'content': item.content,
+        'link': item.link,
+        'published': item.published.isoformat(),
+    }
@@ -23,6 +23,7 @@ if not settings.configured:
             'lifestreams.plugins.lifestream_rss',
         ),
         SITE_ID=1,
+        ROOT_URLCONF='lifestreams.urls',
         SECRET_KEY='this-is-just-for-tests-so-not-that-secret',
         LOGGING = {
             'version': 1,
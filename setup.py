@@ -31,7 +31,7 @@ setup (
       'Topic :: Software Development :: Libraries :: Python Modules',
     ],
     install_requires = [
-      'Django>=1.4',
+      'Django>=1.5',
       'pytz>=2013b'    ],
     tests_require = [
       'mock>=1.0.1',